@@ -1,13 +1,17 @@
-import pickle
+import json
+import multiprocessing
+import os
+import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from itertools import count
 
-import redis
 import beelib
-import neo4j
 import pandas as pd
 import xml.etree.ElementTree as ElementTree
 from harmonizers.post_process.pv_postprocess import PVProcessor
+from harmonizers.stages import create_stage, run_stages, create_worker, stop_worker
 from harmonizers.sources.dexma import dexma, dexma_projects
 from harmonizers.sources.modbus import modbus
 from harmonizers.sources.ixon import ixon
@@ -15,8 +19,19 @@ from harmonizers.sources.meteogalicia import meteogalicia
 from harmonizers.sources.agbar import agbar
 from harmonizers.sources.manttest import manttest, manttest_eco
 from harmonizers.sources.bacnet import bacnet
-from lib2 import harmonize_irregular_data, send_to_kafka
-from lib2.calculate_formulas import CalculateFunctions
+from lib2 import gap_segments, harmonize_irregular_data, send_to_kafka, rollup_harmonized_data
+from lib2.calculate_formulas import CalculateFunctions, formula_uris
+from lib2.clean_outliers import no_clean
+from lib2.connections import get_redis, run_query, close_all, query_stats, get_neo4j, get_hbase_pool, \
+    check_connections
+from lib2.hbase import configure_shared_scans
+from lib2.pipeline import BackgroundSender
+from lib2.redis_queue import order_by_cost, publish_devices
+from lib2.query_cache import QUERY_CACHE_TTL, create_query_cache, cached_query, invalidate_queries
+from lib2.raw_cache import configure_raw_cache
+from lib2.redis_sync import reset_barrier, open_barrier, barrier_wait, delete_barrier, wait_gates
+from lib2.time_buckets import comparable_freq
+from lib2.watermarks import create_watermarks, read_start, advance
 import logging
 from pythonjsonlogger import jsonlogger
 import numpy as np
@@ -33,317 +48,689 @@ sources = [dexma, dexma_projects, meteogalicia, modbus, bacnet, agbar, ixon, man
 
 post_processors = [PVProcessor]
 
+# device queries run at the same time by the starter
+DISCOVERY_THREADS = 8
+
+CALCULATION_QUERY = """
+    MATCH (m)-[:s4city__quantifiesKPI|:saref__relatesToProperty]->(prop) 
+    WHERE m.bee__calculationFormula IS NOT NULL AND m.bigg__measurementFrequency=$freq
+    RETURN {bigg__hash: m.bigg__hash, 
+    bee__calculationFormula: m.bee__calculationFormula, 
+    bigg__measurementFrequency: m.bigg__measurementFrequency,
+    property:prop.uri} AS m
+"""
+
+LIMITS_QUERY = """
+match (property:s4city__KeyPerformanceIndicator)<-[:s4city__quantifiesKPI]-(kpi)-[:s4city__assesses]->(dev:bee__BmsDevice)-
+[:saref__makesMeasurement]->(lower:bigg__LimitMeasurement)-[s4ener__hasUsage]->(l:s4ener__Usage) where lower.uri contains
+'limit-lower' and kpi.bigg__measurementFrequency=$freq and property.uri contains 'Compliance'
+match (dev)-[:saref__makesMeasurement]->(upper:bigg__LimitMeasurement) where upper.uri contains 'limit-upper'
+match (dev)-[:saref__makesMeasurement]->(dev_m:saref__Measurement)
+match (dev)-[:bigg__isConditionedBy]->(dev_cond)
+match (dev_cond)-[:saref__makesMeasurement]->()<-[:owl__sameAs]-(cond_m)
+return distinct({kpi__hash:kpi.bigg__hash, bigg__measurementFrequency:kpi.bigg__measurementFrequency,
+lower__activation:lower.bee__activationLimit, lower__formula:lower.bee__calculationFormula, upper__activation:upper.bee__activationLimit,
+upper__formula:upper.bee__calculationFormula,measurement_hash:dev_m.bigg__hash, property:property.uri}) as m
+"""
+
+LIMITS_FORMULA_FIELDS = ["lower__activation", "lower__formula", "upper__activation", "upper__formula"]
+
+# harmonized fields that must match, besides the raw data, to harmonize several frequencies from the same data
+ROLLUP_GROUP_FIELDS = ["harmonized.property", "harmonized.aggregationFunction",
+                       "harmonized.harmonized_unitConversionRatio", "harmonized.harmonized_unitConversionOffset"]
+
 
 def create_redis_name(queue, freq, diff):
     return ".".join([x for x in [queue, freq, diff] if x])
 
 
-def init_redis(redis_conn, freq, diff, num_processors):
-    redis_base = create_redis_name("harmonizer.start", freq['freq'], diff)
-    redis_conn.set(f"{redis_base}.semaphore", 0)
+def raw_cost_key(dev):
+    # also the field of the watermark of the device, a measurement can be fed by several raw devices
+    return f"{dev['harmonized.bigg__hash']}~{dev['raw_data.uri']}"
+
+
+def post_cost_key(dev):
+    return dev['patrimony']
+
+
+def calculation_cost_key(dev):
+    return dev['bigg__hash']
+
+
+def limits_cost_key(dev):
+    return dev['kpi__hash']
+
+
+def run_freq_name(freq, rollup_freqs=()):
+    """
+    Name of the frequency of the run in redis, a run rolling up several frequencies is named after all of them
+    """
+    return "+".join([freq['freq']] + [f['freq'] for f in rollup_freqs])
+
+
+def init_redis(redis_conn, freq, diff, num_processors, rollup_freqs=()):
+    """
+    Resets the queues and barriers of the run. The start barrier, the raw sources and the derived stages of each
+    frequency are closed until the starter opens them.
+    """
+    run_freq = run_freq_name(freq, rollup_freqs)
+    reset_barrier(redis_conn, create_redis_name("harmonizer.start", run_freq, diff), 0)
     for source_config in sources:
-        redis_base = create_redis_name(f"harmonizer.{source_config['name'].lower()}", freq['freq'], diff)
-        redis_conn.set(f"{redis_base}.semaphore", num_processors)
+        redis_base = create_redis_name(f"harmonizer.{source_config['name'].lower()}", run_freq, diff)
+        reset_barrier(redis_conn, redis_base, 0)
         redis_conn.delete(f"{redis_base}.queue")
-    for post in post_processors:
-        redis_base = create_redis_name(f"harmonizer.{post.name.lower()}", freq['freq'], diff)
-        redis_conn.set(f"{redis_base}.semaphore", num_processors)
+    for f in [freq] + list(rollup_freqs):
+        reset_barrier(redis_conn, create_redis_name("harmonizer.derived", f['freq'], diff), 0)
+        for post in post_processors:
+            redis_base = create_redis_name(f"harmonizer.{post.name.lower()}", f['freq'], diff)
+            reset_barrier(redis_conn, redis_base, num_processors)
+            redis_conn.delete(f"{redis_base}.queue")
+
+        redis_base = create_redis_name("harmonizer.calculation.0", f['freq'], diff)
+        reset_barrier(redis_conn, redis_base, num_processors)
         redis_conn.delete(f"{redis_base}.queue")
+        redis_base = create_redis_name("harmonizer.calculation", f['freq'], diff)
+        redis_conn.set(f"{redis_base}.max_prio", 1)
 
-    redis_base = create_redis_name("harmonizer.calculation.0", freq['freq'], diff)
-    redis_conn.set(f"{redis_base}.semaphore", num_processors)
-    redis_conn.delete(f"{redis_base}.queue")
-    redis_base = create_redis_name("harmonizer.calculation", freq['freq'], diff)
-    redis_conn.set(f"{redis_base}.max_prio", 1)
+        redis_base = create_redis_name("harmonizer.limits", f['freq'], diff)
+        reset_barrier(redis_conn, redis_base, num_processors)
+        redis_conn.delete(f"{redis_base}.queue")
 
-    redis_base = create_redis_name("harmonizer.limits", freq['freq'], diff)
-    redis_conn.set(f"{redis_base}.semaphore", num_processors)
-    redis_conn.delete(f"{redis_base}.queue")
+    redis_base = create_redis_name("harmonizer.workers", run_freq, diff)
+    redis_conn.delete(f"{redis_base}.workers")
 
 
-def wait_sync_redis(redis_conn, queue, freq, diff, num_proc, time_min):
-    timeout = time.time() + 60 * time_min  # timeout  minutes
-    redis_base = create_redis_name(queue, freq['freq'], diff)
-    while True:
+def check_clients(phase):
+    """
+    Checks the clients created by the process, so a run with a service down fails at once instead of on its first
+    device.
+    """
+    errors = check_connections()
+    if errors:
+        logger.error("Clients down", extra={'phase': phase, "errors": errors})
+        raise ConnectionError(f"Clients down: {', '.join(errors)}")
+
+
+def process_participant():
+    """
+    Name of the process at the barriers, unique for each of the processes of a host
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def wait_sync_redis(redis_conn, queue, freq, diff, num_proc, time_min, weight=1, participant=None, rollup_freqs=()):
+    redis_base = create_redis_name(queue, run_freq_name(freq, rollup_freqs), diff)
+    logger.debug("Waiting All tickets", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore"})
+    sync = barrier_wait(redis_conn, redis_base, num_proc, time_min, weight, participant)
+    logger.debug("All sync", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore", **sync})
+    return sync
+
+
+def run_device_query(neo4j_connection, query, **params):
+    for attempt in range(5):
         try:
-            ticket = int(redis_conn.get(f"{redis_base}.semaphore"))
-        except Exception:
-            ticket = 0
-        if ticket:
-            l = int(redis_conn.decr(f"{redis_base}.semaphore"))
-            if l < 0:
-                raise ValueError("The semaphore can't be negative")
-            logger.debug("Ticket obtained", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore",
-                                                   "ticket": l})
-            break
-        time.sleep(1)
-        if time.time() > timeout:
-            raise TimeoutError("The process starting was too slow")
-    while True:
-        logger.debug("Waiting All tickets", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore",
-                                                   "ticket": l})
+            return run_query(neo4j_connection, query, **params)
+        except Exception as e:
+            pass
+    return None
+
+
+def _flatten_record_(record, prefix=""):
+    flat = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            flat.update(_flatten_record_(v, f"{prefix}{k}."))
+        else:
+            flat[f"{prefix}{k}"] = v
+    return flat
+
+
+def flatten_devices(records):
+    """
+    Builds the flat devices from the records of a device query: nested maps are joined with "." and each record
+    gives a device for every element of its `raw_data` list, with its fields as "raw_data.<field>".
+    """
+    devices = []
+    for record in records:
+        raw_data = record['raw_data']
+        base = _flatten_record_({k: v for k, v in record.items() if k != "raw_data"})
+        for raw in raw_data if isinstance(raw_data, list) and raw_data else [raw_data]:
+            dev = dict(base)
+            if isinstance(raw, dict):
+                dev.update({f"raw_data.{k}": v for k, v in raw.items()})
+            devices.append(dev)
+    return devices
+
+
+def query_source_devices(neo4j_connection, source_config, freq, query_cache=None):
+    """
+    Returns the flat devices of the source, reading the results of its queries through `query_cache`. All the
+    devices have the same fields, the fields missing in the records of a query are NaN.
+    """
+    source_devices = []
+    for s_t in source_config['device_query']:
         try:
-            ticket = int(redis_conn.get(f"{redis_base}.semaphore"))
-        except Exception:
-            ticket = 0
-        if ticket == 0:
-            logger.debug("All sync", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore",
-                                            "ticket": l})
+            params = {"freq": freq['freq']}
+            devices = cached_query(query_cache, source_config['name'], s_t, params,
+                                   partial(run_device_query, neo4j_connection, s_t, **params))
+            if not devices:
+                continue
+            source_devices.extend(flatten_devices(devices))
+        except KeyError:
+            pass
+    fields = list(dict.fromkeys(k for dev in source_devices for k in dev))
+    return [dev if len(dev) == len(fields) else {k: dev.get(k, np.nan) for k in fields} for dev in source_devices]
+
+
+def group_rollup_devices(devices_by_freq):
+    """
+    Groups the devices of several frequencies (given from the finest) that read the same raw data with the same
+    conversion, so it is only read once. Each group keeps the harmonized fields of every frequency in `targets`.
+    """
+    groups = {}
+    for freq, source_devices in devices_by_freq.items():
+        for dev in source_devices:
+            target = {k: v for k, v in dev.items() if k.startswith("harmonized.")}
+            key = json.dumps([[k, v] for k, v in sorted(dev.items()) if k.startswith("raw_data.") or
+                              k in ROLLUP_GROUP_FIELDS], default=str)
+            if key not in groups:
+                groups[key] = dict(dev, targets=[])
+            groups[key]['targets'].append(dict(target, freq=freq))
+    return list(groups.values())
+
+
+def discover_source(neo4j_connection, redis_conn, source_config, freq, diff, num_processors, version, query_cache,
+                    rollup_freqs=()):
+    """
+    Publishes the devices of the source and opens the gate of its stage, so the workers start processing it while
+    the rest of sources are discovered. The gate is opened even if the discovery fails, with the stage empty.
+    """
+    run_freq = run_freq_name(freq, rollup_freqs)
+    cost_key = create_redis_name("harmonizer.cost", run_freq, diff)
+    redis_base = create_redis_name(f"harmonizer.{source_config['name'].lower()}", run_freq, diff)
+    logger.info("Reading from", extra={'phase': "GATHER", "source": source_config['name']})
+    try:
+        if rollup_freqs:
+            source_devices = group_rollup_devices({f['freq']: query_source_devices(neo4j_connection,
+                                                                                   source_config, f, query_cache)
+                                                   for f in [freq] + list(rollup_freqs)})
+        else:
+            source_devices = query_source_devices(neo4j_connection, source_config, freq, query_cache)
+        if not source_devices:
+            logger.info("No devices from source", extra={'phase': "GATHER", "source": source_config['name']})
             return
-        if time.time() > timeout:
-            raise TimeoutError("The process starting was too slow")
+        logger.info("Readed", extra={'phase': "GATHER", "source": source_config['name'],
+                                     "devices": len(source_devices)})
+        source_devices = order_by_scan(order_by_cost(redis_conn, cost_key, source_devices, raw_cost_key))
+        publish_devices(redis_conn, redis_base, source_devices, version)
+    except Exception as e:
+        logger.error("Failed to read devices", extra={'phase': "GATHER", "source": source_config['name'],
+                                                      "error": str(e)})
+    finally:
+        open_barrier(redis_conn, redis_base, num_processors)
+
+
+def discover_derived(neo4j_connection, redis_conn, freq, diff, num_processors, actions, version):
+    """
+    Publishes the devices of the stages computed from the harmonized data of the frequency and opens their gate
+    """
+    try:
+        publish_derived_devices(redis_conn, neo4j_connection, freq, diff, num_processors, actions, version)
+    except Exception as e:
+        logger.error("Failed to read devices", extra={'phase': "GATHER", "source": f"derived {freq['freq']}",
+                                                      "error": str(e)})
+    finally:
+        open_barrier(redis_conn, create_redis_name("harmonizer.derived", freq['freq'], diff), num_processors)
 
 
-def starter_job(neo4j_connection, redis_connection, freq, diff, num_processors, actions):
+def order_by_scan(devices):
+    """
+    Keeps together the devices reading the same raw rows, at the position of the first of them, so they are claimed
+    and prefetched together by a worker and the rows are only scanned once
+    """
+    groups = {}
+    for dev in devices:
+        groups.setdefault((dev.get('raw_data.uri'), dev.get('raw_data.freq')), []).append(dev)
+    return [dev for group in groups.values() for dev in group]
+
+
+def starter_job(neo4j_connection, redis_connection, freq, diff, num_processors, actions, rollup_freqs=(),
+                query_cache_ttl=QUERY_CACHE_TTL, refresh_devices=False, discovery_threads=DISCOVERY_THREADS):
+    """
+    Publishes the devices of the run. With `rollup_freqs`, the coarser frequencies are processed in the same run:
+    the raw devices of all of them are grouped by raw data and the rest of stages are published by frequency.
+    The results of the device queries are cached in redis for `query_cache_ttl` seconds, `refresh_devices`
+    invalidates them before the run. The processors are started once the queues are reset, the devices of each
+    queue are discovered with `discovery_threads` concurrent queries and the queue is opened once published.
+    """
     logger.info("Starting the ingestor", extra={'phase': "START"})
-    driver = neo4j.GraphDatabase.driver(**neo4j_connection)
-    redis_conn = redis.Redis(**redis_connection)
+    redis_conn = get_redis(redis_connection)
+    get_neo4j(neo4j_connection)
+    check_clients("START")
+    run_freq = run_freq_name(freq, rollup_freqs)
+    version = int(time.time())
+    query_cache = create_query_cache(redis_conn, ttl=query_cache_ttl)
+    if refresh_devices:
+        logger.info("Invalidating device queries", extra={'phase': "START",
+                                                          "queries": invalidate_queries(query_cache)})
     # set all redis to initial state
-    init_redis(redis_conn, freq, diff, num_processors)
-    # SET devices by source
-    if "raw" in actions:
-        for source_config in sources:
-            redis_base = create_redis_name(f"harmonizer.{source_config['name'].lower()}", freq['freq'], diff)
-            logger.info("Reading from", extra={'phase': "GATHER", "source": source_config['name']})
-            source_devices = pd.DataFrame()
-            for s_t in source_config['device_query']:
-                try:
-                    devices = []
-                    for attempt in range(5):
-                        try:
-                            devices = driver.session().run(s_t.format(freq=freq['freq'])).data()
-                            break
-                        except Exception as e:
-                            pass
-                    if not devices:
-                        continue
-                    device_df = pd.json_normalize(devices).explode("raw_data")
-                    device_df = pd.concat([device_df.drop('raw_data', axis=1),
-                                           device_df['raw_data'].apply(pd.Series).rename(
-                                               columns={c: f"raw_data.{c}" for c in
-                                                        device_df['raw_data'].apply(pd.Series).columns})], axis=1)
-                    source_devices = pd.concat([source_devices, device_df])
-                except KeyError:
-                    pass
-            if source_devices.empty:
-                logger.info("No devices from source", extra={'phase': "GATHER", "source": source_config['name']})
-                continue
-            logger.info("Readed", extra={'phase': "GATHER", "source": source_config['name'],
-                                         "devices": len(source_devices)})
-            for _, dev in source_devices.iterrows():
-                redis_conn.lpush(f"{redis_base}.queue",
-                                 pickle.dumps(dev.to_dict()))
+    init_redis(redis_conn, freq, diff, num_processors, rollup_freqs)
+    redis_base = create_redis_name("harmonizer.start", run_freq, diff)
+    open_barrier(redis_conn, redis_base, num_processors)
+    logger.debug("Redis Base", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore"})
+    with ThreadPoolExecutor(discovery_threads) as pool:
+        # SET devices by source
+        if "raw" in actions:
+            for source_config in sources:
+                pool.submit(discover_source, neo4j_connection, redis_conn, source_config, freq, diff, num_processors,
+                            version, query_cache, rollup_freqs)
+        for f in [freq] + list(rollup_freqs):
+            pool.submit(discover_derived, neo4j_connection, redis_conn, f, diff, num_processors, actions, version)
+    logger.debug("Neo4j queries", extra={'phase': "START", "queries": query_stats()})
+    close_all()
+
+
+def publish_derived_devices(redis_conn, neo4j_connection, freq, diff, num_processors, actions, version):
+    """
+    Publishes the devices of the stages computed from the harmonized data of the frequency
+    """
+    cost_key = create_redis_name("harmonizer.cost", freq['freq'], diff)
+    calculator = CalculateFunctions({}, {}, {}, neo4j_connection, {})
     # SET devices by post processors
     if "processors" in actions:
         for post in post_processors:
             logger.info("Applying post Processor", extra={'phase': "GATHER", "source": post.name})
             redis_base = create_redis_name(f"harmonizer.{post.name.lower()}", freq['freq'], diff)
-            query = post.get_devices(freq)
-            devices = driver.session().run(query).data()
+            devices = run_query(neo4j_connection, post.get_devices(), freq=freq['freq'])
             if not devices:
                 continue
             logger.info("Applying over devices", extra={'phase': "GATHER", "source": post.name,
                                                         "devices": len(devices)})
-            for dev in devices:
-                redis_conn.lpush(f"{redis_base}.queue", pickle.dumps(dev))
+            publish_devices(redis_conn, redis_base, order_by_cost(redis_conn, cost_key, devices, post_cost_key),
+                            version)
     # SET devices for calculation formulas
     if "calculations" in actions:
         logger.info("Applying post Calculations", extra={'phase': "GATHER", "source": "Calculation"})
-        calc_query = f"""
-                MATCH (m)-[:s4city__quantifiesKPI|:saref__relatesToProperty]->(prop) 
-                WHERE m.bee__calculationFormula IS NOT NULL AND m.bigg__measurementFrequency="{freq['freq']}"
-                RETURN {{bigg__hash: m.bigg__hash, 
-                bee__calculationFormula: m.bee__calculationFormula, 
-                bigg__measurementFrequency: m.bigg__measurementFrequency,
-                property:prop.uri}} AS m
-            """
-        devices = driver.session().run(calc_query).data()
-        calculator = CalculateFunctions({}, {}, {}, neo4j_connection,
-                                        {})
+        devices = run_query(neo4j_connection, CALCULATION_QUERY, freq=freq['freq'])
         devices_priority = calculator.order_by_dependencies(devices)
         prio = 0
         for prio, devices in devices_priority.items():
             redis_base = create_redis_name(f"harmonizer.calculation.{prio}", freq['freq'], diff)
-            redis_conn.set(f"{redis_base}.semaphore", num_processors)
+            reset_barrier(redis_conn, redis_base, num_processors)
             logger.info("Applying Calculations over devices", extra={'phase': "GATHER", "source": "Calculation",
                                                                      "devices": len(devices), "priority": prio})
-            redis_conn.delete(f"{redis_base}.queue")
-            for dev in [x['m'] for x in devices]:
-                redis_conn.lpush(f"{redis_base}.queue", pickle.dumps(dev))
+            publish_devices(redis_conn, redis_base,
+                            order_by_cost(redis_conn, cost_key, [x['m'] for x in devices], calculation_cost_key),
+                            version)
         redis_base = create_redis_name(f"harmonizer.calculation", freq['freq'], diff)
         redis_conn.set(f"{redis_base}.max_prio", prio)
 
     if "limits" in actions:
         logger.info("Applying compliance", extra={'phase': "GATHER", "source": "Compliance"})
-        limits_query = f"""
-        match (property:s4city__KeyPerformanceIndicator)<-[:s4city__quantifiesKPI]-(kpi)-[:s4city__assesses]->(dev:bee__BmsDevice)-
-        [:saref__makesMeasurement]->(lower:bigg__LimitMeasurement)-[s4ener__hasUsage]->(l:s4ener__Usage) where lower.uri contains
-        'limit-lower' and kpi.bigg__measurementFrequency="{freq['freq']}" and property.uri contains 'Compliance'
-        match (dev)-[:saref__makesMeasurement]->(upper:bigg__LimitMeasurement) where upper.uri contains 'limit-upper'
-        match (dev)-[:saref__makesMeasurement]->(dev_m:saref__Measurement)
-        match (dev)-[:bigg__isConditionedBy]->(dev_cond)
-        match (dev_cond)-[:saref__makesMeasurement]->()<-[:owl__sameAs]-(cond_m)
-        return distinct({{kpi__hash:kpi.bigg__hash, bigg__measurementFrequency:kpi.bigg__measurementFrequency,
-        lower__activation:lower.bee__activationLimit, lower__formula:lower.bee__calculationFormula, upper__activation:upper.bee__activationLimit,
-        upper__formula:upper.bee__calculationFormula,measurement_hash:dev_m.bigg__hash, property:property.uri}}) as m
-        """
-        devices = driver.session().run(limits_query).data()
+        devices = run_query(neo4j_connection, LIMITS_QUERY, freq=freq['freq'])
         redis_base = create_redis_name(f"harmonizer.limits", freq['freq'], diff)
 
         if devices:
             logger.info("Applying over devices", extra={'phase': "GATHER", "source": "Compliance",
                                                         "devices": len(devices)})
+            calculator.resolve_measurements([u for x in devices for f in LIMITS_FORMULA_FIELDS
+                                             for u in formula_uris(x['m'][f])])
 
-            for dev in [x['m'] for x in devices]:
-                redis_conn.lpush(f"{redis_base}.queue", pickle.dumps(dev))
+            publish_devices(redis_conn, redis_base,
+                            order_by_cost(redis_conn, cost_key, [x['m'] for x in devices], limits_cost_key),
+                            version)
+    publish_measurements(redis_conn, freq, diff, calculator.measurements)
 
-    redis_base = create_redis_name("harmonizer.start", freq['freq'], diff)
-    redis_conn.set(f"{redis_base}.semaphore", num_processors)
-    logger.debug("Redis Base", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore"})
 
+def publish_measurements(redis_conn, freq, diff, measurements):
+    """
+    Publishes the measurements of the devices referenced by the formulas of the run, resolved in bulk by the
+    starter, so the workers don't query them device by device
+    """
+    redis_conn.set(create_redis_name("harmonizer.measurements", freq['freq'], diff), json.dumps(measurements))
 
-def processor_job(redis_connection, kafka_connection, hbase_connection, druid_topic, druid_connection, druid_datasource,
-                  influx_connection, neo4j_connection, ts_ini, ts_end, freq, diff, num_processors, actions):
-    redis_conn = redis.Redis(**redis_connection)
-    logger.debug("Wait To Start", extra={'phase': "GATHER"})
-    wait_sync_redis(redis_conn, "harmonizer.start", freq, diff, num_processors, 5)
-    # process raw_data
-    druid_producer = beelib.beekafka.create_kafka_producer(kafka_connection, encoding="JSON")
+
+def load_measurements(redis_conn, freq, diff):
+    measurements = redis_conn.get(create_redis_name("harmonizer.measurements", freq['freq'], diff))
+    return json.loads(measurements) if measurements else {}
+
+
+def harmonized_to_druid(dev, df_device_final, freq):
+    df_device_final['property'] = (dev['harmonized.property'].
+                                   replace("https://bigg-project.eu/ontology#", "").
+                                   replace("https://saref.etsi.org/core/", "").
+                                   replace("https://www.beegroup-cimne.com/bee/ontology#", ""))
+    df_device_final['hash'] = dev['harmonized.bigg__hash']
+    df_device_final['value'] = df_device_final['value'].round(5)
+    return df_device_final.reset_index().apply(
+        beelib.beedruid.harmonize_for_druid, timestamp_key="timestamp", value_key="value",
+        hash_key="hash",
+        property_key="property", is_real=True, freq=freq,
+        axis=1)
+
+
+def process_raw_device(dev, source_config, send, druid_topic, hbase_connection, ts_ini, ts_end, freq, fetched=None,
+                       watermarks=None):
+    """
+    Harmonizes the data of a raw device and sends it with `send(topic, data, on_sent)`. The raw data is taken from
+    the `fetched` future when it has been prefetched. With `watermarks`, the watermark of the device is moved to
+    the last point harmonized once it has been sent. Returns the number of raw rows, used as the device cost
+    """
+    s = time.time()
+    rows = 0
+    try:
+        if fetched is not None:
+            raw_data = fetched.result()
+        else:
+            raw_data = get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq, watermarks)
+        rows = len(raw_data)
+        df_device_final = harmonize_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq,
+                                             raw_data=raw_data)
+        if (df_device_final is not None) and not df_device_final.empty:
+            df_to_save = harmonized_to_druid(dev, df_device_final, freq['freq'])
+            if df_to_save.empty:
+                return rows
+            logger.debug("time harmonize + hbase",
+                         extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
+            s = time.time()
+            on_sent = None
+            if watermarks:
+                on_sent = partial(advance, watermarks, raw_cost_key(dev), df_device_final.index.max().timestamp())
+            send(druid_topic, df_to_save, on_sent)
+            logger.debug("time kafka",
+                         extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
+    except Exception as e:
+        logger.error("Failed to harmonize raw",
+                     extra={'phase': "GATHER", "dev": dev, "source": source_config['name'], "error": str(e)})
+    return rows
+
+
+def rollup_starts(dev, windows):
+    """
+    Returns the timestamp from which the data of each target of a grouped device is needed: the start of the window
+    of its frequency or, in incremental mode, its watermark minus the overlap.
+    """
+    starts = []
+    for target in dev['targets']:
+        window = windows[target['freq']]
+        start = window['ts_ini']
+        if window['watermarks']:
+            start = read_start(window['watermarks'], raw_cost_key(dict(dev, **target)), start, target['freq'])
+        starts.append(start)
+    return starts
+
+
+def get_rollup_raw_data(dev, source_config, hbase_connection, ts_end, windows):
+    return get_raw_data(dev, source_config, hbase_connection, min(rollup_starts(dev, windows)), ts_end,
+                        windows[dev['targets'][0]['freq']]['freq'])
+
+
+def process_rollup_device(dev, source_config, send, druid_topic, hbase_connection, ts_end, windows, fetched=None):
+    """
+    Harmonizes the raw data of a grouped device for all its frequencies, reading it once, and sends it with
+    `send(topic, data, on_sent)`. Returns the number of raw rows, used as the device cost
+    """
+    s = time.time()
+    rows = 0
+    try:
+        starts = rollup_starts(dev, windows)
+        if fetched is not None:
+            raw_data = fetched.result()
+        else:
+            raw_data = get_raw_data(dev, source_config, hbase_connection, min(starts), ts_end,
+                                    windows[dev['targets'][0]['freq']]['freq'])
+        rows = len(raw_data)
+        if raw_data.empty:
+            return rows
+        for target_dev, df_device_final in harmonize_rollup_data(dev, source_config, raw_data, windows, starts):
+            df_to_save = harmonized_to_druid(target_dev, df_device_final, target_dev['freq'])
+            if df_to_save.empty:
+                continue
+            watermarks = windows[target_dev['freq']]['watermarks']
+            on_sent = None
+            if watermarks:
+                on_sent = partial(advance, watermarks, raw_cost_key(target_dev),
+                                  df_device_final.index.max().timestamp())
+            send(druid_topic, df_to_save, on_sent)
+        logger.debug("time harmonize + hbase",
+                     extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
+    except Exception as e:
+        logger.error("Failed to harmonize raw",
+                     extra={'phase': "GATHER", "dev": dev, "source": source_config['name'], "error": str(e)})
+    return rows
+
+
+def process_post_device(dev, post, druid_producer, druid_connection, druid_datasource, druid_topic,
+                        influx_connection, ts_ini, ts_end, freq):
+    try:
+        post.process_device(dev, druid_producer, druid_connection, druid_datasource, druid_topic,
+                            influx_connection, ts_ini, ts_end, freq)
+    except Exception as e:
+        logger.error("Failed to postProcess devices",
+                     extra={'phase': "GATHER", "dev": dev, "source": post.name.lower(), "error": str(e)})
+
+
+def process_calculation_device(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
+                               influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements=None):
+    try:
+        harmonize_calculation_devices(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
+                                      influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements)
+    except Exception as e:
+        logger.error("Failed to calculate devices",
+                     extra={'phase': "GATHER", "dev": dev, "source": "calculation", "error": str(e)})
+
+
+def process_limits_device(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
+                          influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements=None):
+    try:
+        harmonize_limits(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
+                         influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements)
+        logger.debug("Limit processed", extra={'phase': "GATHER", "source": "Compliance", "dev": dev['kpi__hash']})
+    except Exception as e:
+        logger.error(f"Failed to compliance devices {e}",
+                     extra={'phase': "GATHER", "dev": dev['kpi__hash'], "source": "Compliance", "error": str(e)})
+
+
+def get_processor_stages(redis_conn, hbase_connection, druid_topic, druid_connection,
+                         druid_datasource, influx_connection, neo4j_connection, druid_producer, sender, ts_ini, ts_end,
+                         freq, diff, actions, incremental=False, rollup_freqs=()):
+    """
+    Builds the stages of the run with their real dependencies: raw sources are independent from each other,
+    post processors need all the raw data, calculations need the post processed data and each priority level
+    the previous one, and limits need all the calculations. Returns the raw stages, opened as their devices are
+    published, and the function building the rest of stages once the starter has published them. When `incremental`, the raw data of each device is
+    only read from its watermark. With `rollup_freqs`, a list of (freq, ts_ini) of coarser frequencies, the raw
+    devices are harmonized for all the frequencies at once and the rest of stages are built for each frequency.
+    """
+    stages = []
+    layer = []
+    run_freq = run_freq_name(freq, [f for f, _ in rollup_freqs])
+    cost_key = create_redis_name("harmonizer.cost", run_freq, diff)
+    windows = {}
+    for f, f_ts_ini in [(freq, ts_ini)] + list(rollup_freqs):
+        watermarks = None
+        if incremental:
+            watermarks = create_watermarks(redis_conn, create_redis_name("harmonizer.watermark", f['freq'], diff),
+                                           f['watermark_overlap'])
+        windows[f['freq']] = {"freq": f, "ts_ini": f_ts_ini, "watermarks": watermarks}
     if "raw" in actions:
         for source_config in sources:
-            logger.debug("Processing from", extra={'phase': "GATHER", "source": source_config['name'].lower()})
-            redis_base = create_redis_name(f"harmonizer.{source_config['name'].lower()}", freq['freq'], diff)
-            while True:
-                dev = redis_conn.rpop(f"{redis_base}.queue")
-                if not dev:
-                    break
-                dev = pickle.loads(dev)
-                logger.debug("Processing from", extra={'phase': "GATHER", "source": source_config['name'].lower(),
-                                                       "len": redis_conn.llen(f"{redis_base}.queue"),
-                                                       "dev": dev})
-                s = time.time()
-                try:
-                    df_device_final = harmonize_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq)
-                    if (df_device_final is not None) and not df_device_final.empty:
-                        df_device_final['property'] = (dev['harmonized.property'].
-                                                       replace("https://bigg-project.eu/ontology#", "").
-                                                       replace("https://saref.etsi.org/core/", "").
-                                                       replace("https://www.beegroup-cimne.com/bee/ontology#", ""))
-                        df_device_final['hash'] = dev['harmonized.bigg__hash']
-                        df_device_final['value'] = df_device_final['value'].round(5)
-                        df_to_save = df_device_final.reset_index().apply(
-                            beelib.beedruid.harmonize_for_druid, timestamp_key="timestamp", value_key="value",
-                            hash_key="hash",
-                            property_key="property", is_real=True, freq=freq['freq'],
-                            axis=1)
-                        if df_to_save.empty:
-                            continue
-                        logger.debug("time harmonize + hbase",
-                                     extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
-                        s = time.time()
-                        data = send_to_kafka(druid_producer, druid_topic, df_to_save)
-                        logger.debug("time kafka",
-                                     extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
-                except Exception as e:
-                    logger.error("Failed to harmonize raw",
-                                 extra={'phase': "GATHER", "dev": dev, "source": source_config['name'], "error": str(e)})
-
-            wait_sync_redis(redis_conn, f"harmonizer.{source_config['name'].lower()}",
-                            freq, diff, num_processors, 60)
-    # post processors
+            if rollup_freqs:
+                process = partial(process_rollup_device, source_config=source_config, send=sender.send,
+                                  druid_topic=druid_topic, hbase_connection=hbase_connection, ts_end=ts_end,
+                                  windows=windows)
+                fetch = partial(get_rollup_raw_data, source_config=source_config, hbase_connection=hbase_connection,
+                                ts_end=ts_end, windows=windows)
+            else:
+                watermarks = windows[freq['freq']]['watermarks']
+                process = partial(process_raw_device, source_config=source_config, send=sender.send,
+                                  druid_topic=druid_topic, hbase_connection=hbase_connection, ts_ini=ts_ini,
+                                  ts_end=ts_end, freq=freq, watermarks=watermarks)
+                fetch = partial(get_raw_data, source_config=source_config, hbase_connection=hbase_connection,
+                                ts_ini=ts_ini, ts_end=ts_end, freq=freq, watermarks=watermarks)
+            layer.append(create_stage(source_config['name'].lower(),
+                                      create_redis_name(f"harmonizer.{source_config['name'].lower()}", run_freq,
+                                                        diff),
+                                      [], process, cost=(cost_key, raw_cost_key), fetch=fetch, sender=sender,
+                                      gated=True))
+        stages.extend(layer)
+    more_stages = partial(wait_derived_stages, redis_conn, layer, druid_topic, druid_connection, druid_datasource,
+                          influx_connection, neo4j_connection, druid_producer, ts_end,
+                          [(freq, ts_ini)] + list(rollup_freqs), diff, actions)
+    return stages, more_stages
+
+
+def wait_derived_stages(redis_conn, layer, druid_topic, druid_connection, druid_datasource, influx_connection,
+                        neo4j_connection, druid_producer, ts_end, freqs, diff, actions):
+    """
+    Waits until the starter has published the derived devices of each of the (freq, ts_ini) in `freqs` and builds
+    their stages, after the stages in `layer`
+    """
+    pending = [create_redis_name("harmonizer.derived", f['freq'], diff) for f, _ in freqs]
+    while pending:
+        pending.remove(wait_gates(redis_conn, pending, 60))
+    stages = []
+    for f, f_ts_ini in freqs:
+        stages.extend(get_derived_stages(redis_conn, layer, druid_topic, druid_connection, druid_datasource,
+                                         influx_connection, neo4j_connection, druid_producer, f_ts_ini, ts_end, f,
+                                         diff, actions))
+    return stages
+
+
+def get_derived_stages(redis_conn, layer, druid_topic, druid_connection, druid_datasource, influx_connection,
+                       neo4j_connection, druid_producer, ts_ini, ts_end, freq, diff, actions):
+    """
+    Builds the stages computed from the harmonized data of the frequency, after the stages in `layer`
+    """
+    stages = []
+    cost_key = create_redis_name("harmonizer.cost", freq['freq'], diff)
+    # index of the measurements of the formulas shared by all the calculators of the worker
+    measurements = load_measurements(redis_conn, freq, diff) if "calculations" in actions or "limits" in actions \
+        else {}
     if "processors" in actions:
-        for post in post_processors:
-            logger.debug("Processing from", extra={'phase': "GATHER", "source": post.name.lower()})
-            redis_base = create_redis_name(f"harmonizer.{post.name.lower()}", freq['freq'], diff)
-            while True:
-                dev = redis_conn.rpop(f"{redis_base}.queue")
-                if not dev:
-                    break
-                dev = pickle.loads(dev)
-                logger.debug("Processing from", extra={'phase': "GATHER", "source": post.name.lower(),
-                                                       "len": redis_conn.llen(f"{redis_base}.queue"),
-                                                       "dev": dev})
-                try:
-                    post.process_device(dev, druid_producer, druid_connection, druid_datasource, druid_topic,
-                                        influx_connection, ts_ini, ts_end, freq)
-                except Exception as e:
-                    logger.error("Failed to postProcess devices",
-                                 extra={'phase': "GATHER", "dev": dev, "source": post.name.lower(), "error": str(e)})
-
-            wait_sync_redis(redis_conn, f"harmonizer.{post.name.lower()}",
-                            freq, diff, num_processors, 60)
-
-    # calculation data
+        layer = [create_stage(post.name.lower(),
+                              create_redis_name(f"harmonizer.{post.name.lower()}", freq['freq'], diff),
+                              layer, partial(process_post_device, post=post, druid_producer=druid_producer,
+                                             druid_connection=druid_connection, druid_datasource=druid_datasource,
+                                             druid_topic=druid_topic, influx_connection=influx_connection,
+                                             ts_ini=ts_ini, ts_end=ts_end, freq=freq),
+                              cost=(cost_key, post_cost_key))
+                 for post in post_processors]
+        stages.extend(layer)
     if "calculations" in actions:
         try:
             redis_base = create_redis_name(f"harmonizer.calculation", freq['freq'], diff)
             max_prio = int(redis_conn.get(f"{redis_base}.max_prio")) + 1
         except:
             max_prio = 1
-
         for prio in range(0, max_prio):
-            logger.debug("Processing from", extra={'phase': "GATHER", "source": "calculation", "prio": prio})
-            redis_base = create_redis_name(f"harmonizer.calculation.{prio}", freq['freq'], diff)
-            while True:
-                dev = redis_conn.rpop(f"{redis_base}.queue")
-                if not dev:
-                    break
-                dev = pickle.loads(dev)
-                logger.debug("Processing from", extra={'phase': "GATHER", "source": "calculation",
-                                                       "len": redis_conn.llen(f"{redis_base}.queue"),
-                                                       "dev": dev})
-                try:
-                    harmonize_calculation_devices(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
-                                                  influx_connection, ts_ini, ts_end, freq, neo4j_connection)
-                except Exception as e:
-                    logger.error("Failed to calculate devices",
-                                 extra={'phase': "GATHER", "dev": dev, "source": "calculation", "error": str(e)})
-            wait_sync_redis(redis_conn, f"harmonizer.calculation.{prio}",
-                            freq, diff, num_processors, 60)
-
+            layer = [create_stage("calculation",
+                                  create_redis_name(f"harmonizer.calculation.{prio}", freq['freq'], diff),
+                                  layer, partial(process_calculation_device, druid_connection=druid_connection,
+                                                 druid_datasource=druid_datasource, druid_producer=druid_producer,
+                                                 druid_topic=druid_topic, influx_connection=influx_connection,
+                                                 ts_ini=ts_ini, ts_end=ts_end, freq=freq,
+                                                 neo4j_connection=neo4j_connection, measurements=measurements),
+                                  cost=(cost_key, calculation_cost_key))]
+            stages.extend(layer)
     if "limits" in actions:
-        logger.debug("Processing from", extra={'phase': "GATHER", "source": "Compliance"})
-        redis_base = create_redis_name(f"harmonizer.limits", freq['freq'], diff)
-        while True:
-            dev = redis_conn.rpop(f"{redis_base}.queue")
-            if not dev:
-                break
-            dev = pickle.loads(dev)
-            logger.debug("Processing from", extra={'phase': "GATHER", "source":"Compliance",
-                                                   "len": redis_conn.llen(f"{redis_base}.queue"),
-                                                   "dev": dev['kpi__hash']})
-            try:
-                harmonize_limits(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
-                                              influx_connection, ts_ini, ts_end, freq, neo4j_connection)
-                logger.debug("Limit processed", extra={'phase': "GATHER", "source": "Compliance",
-                                                       "len": redis_conn.llen(f"{redis_base}.queue"),
-                                                       "dev": dev['kpi__hash']})
-            except Exception as e:
-                logger.error(f"Failed to compliance devices {e}",
-                             extra={'phase': "GATHER", "dev": dev['kpi__hash'], "source": "Compliance", "error": str(e)})
-
-        wait_sync_redis(redis_conn, "harmonizer.limits",
-                        freq, diff, num_processors, 60)
-    redis_conn.delete(f"{create_redis_name('harmonizer.start', freq['freq'], diff)}.semaphore")
-
-
-def get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq):
+        layer = [create_stage("Compliance", create_redis_name(f"harmonizer.limits", freq['freq'], diff),
+                              layer, partial(process_limits_device, druid_connection=druid_connection,
+                                             druid_datasource=druid_datasource, druid_producer=druid_producer,
+                                             druid_topic=druid_topic, influx_connection=influx_connection,
+                                             ts_ini=ts_ini, ts_end=ts_end, freq=freq,
+                                             neo4j_connection=neo4j_connection, measurements=measurements),
+                              dev_log=lambda x: x['kpi__hash'], cost=(cost_key, limits_cost_key))]
+        stages.extend(layer)
+    return stages
+
+
+def processor_worker(redis_connection, kafka_connection, hbase_connection, druid_topic, druid_connection,
+                     druid_datasource, influx_connection, neo4j_connection, ts_ini, ts_end, freq, diff, num_processors,
+                     actions, prefetch, max_inflight_bytes, incremental, rollup_freqs, raw_cache=None):
+    if raw_cache:
+        configure_raw_cache(**raw_cache)
+    redis_conn = get_redis(redis_connection)
+    get_neo4j(neo4j_connection)
+    for server in hbase_connection.values():
+        get_hbase_pool(server['connection'])
+    check_clients("GATHER")
+    druid_producer = beelib.beekafka.create_kafka_producer(kafka_connection, encoding="JSON")
+    # the in-flight budget of the worker is split between the prefetched raw data, the hbase scans kept for the next
+    # devices and the messages waiting for kafka
+    stage_bytes = max_inflight_bytes // 3
+    configure_shared_scans(stage_bytes)
+    sender = BackgroundSender(druid_producer, stage_bytes)
+    stages, more_stages = get_processor_stages(redis_conn, hbase_connection, druid_topic, druid_connection,
+                                               druid_datasource, influx_connection, neo4j_connection, druid_producer,
+                                               sender, ts_ini, ts_end, freq, diff, actions, incremental, rollup_freqs)
+    worker = create_worker(redis_conn, create_redis_name("harmonizer.workers",
+                                                         run_freq_name(freq, [f for f, _ in rollup_freqs]), diff))
+    try:
+        run_stages(redis_conn, stages, num_processors, 60, worker, prefetch, stage_bytes, more_stages)
+    finally:
+        stop_worker(redis_conn, worker)
+        logger.debug("Neo4j queries", extra={'phase': "GATHER", "queries": query_stats()})
+        close_all()
+
+
+def processor_job(redis_connection, kafka_connection, hbase_connection, druid_topic, druid_connection, druid_datasource,
+                  influx_connection, neo4j_connection, ts_ini, ts_end, freq, diff, num_processors, actions, workers=1,
+                  prefetch=4, max_inflight_bytes=256 * 1024 * 1024, incremental=False, rollup_freqs=(),
+                  raw_cache=None):
+    """
+    Processes the queues with `workers` processes. `num_processors` is the total number of workers of the run, each
+    process joins the start barrier once with the weight of all its workers and each worker arrives at the stages.
+    Each worker reads the raw data of the next `prefetch` devices and sends to kafka in background, keeping the
+    data in flight under `max_inflight_bytes`, split in thirds with the hbase scans kept for the next devices.
+    With `incremental`, the raw data of each device is read from its watermark minus the `watermark_overlap` of
+    the frequency, instead of from `ts_ini`.
+    `rollup_freqs` is a list of (freq, ts_ini) of coarser frequencies harmonized in the same run from the raw data
+    read for `freq`. `raw_cache` are the arguments of `configure_raw_cache` to keep the closed days of raw data
+    read from hbase on local disk.
+    """
+    redis_conn = get_redis(redis_connection)
+    logger.debug("Wait To Start", extra={'phase': "GATHER", "workers": workers})
+    wait_sync_redis(redis_conn, "harmonizer.start", freq, diff, num_processors, 5, weight=workers,
+                    participant=process_participant(), rollup_freqs=[f for f, _ in rollup_freqs])
+    worker_args = dict(redis_connection=redis_connection, kafka_connection=kafka_connection,
+                       hbase_connection=hbase_connection, druid_topic=druid_topic, druid_connection=druid_connection,
+                       druid_datasource=druid_datasource, influx_connection=influx_connection,
+                       neo4j_connection=neo4j_connection, ts_ini=ts_ini, ts_end=ts_end, freq=freq, diff=diff,
+                       num_processors=num_processors, actions=actions, prefetch=prefetch,
+                       max_inflight_bytes=max_inflight_bytes, incremental=incremental, rollup_freqs=rollup_freqs,
+                       raw_cache=raw_cache)
+    if workers == 1:
+        processor_worker(**worker_args)
+    else:
+        # each worker creates its own connections, so they are started clean instead of forked
+        ctx = multiprocessing.get_context("spawn")
+        pool = [ctx.Process(target=processor_worker, kwargs=worker_args, name=f"worker-{i}") for i in range(workers)]
+        for p in pool:
+            p.start()
+        for p in pool:
+            p.join()
+            if p.exitcode != 0:
+                logger.error("Worker failed", extra={'phase': "GATHER", "worker": p.name, "exitcode": p.exitcode})
+    delete_barrier(get_redis(redis_connection), create_redis_name('harmonizer.start',
+                                                                  run_freq_name(freq, [f for f, _ in rollup_freqs]),
+                                                                  diff))
+    close_all()
+
+
+def get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq, watermarks=None):
     reg_freq = dev['raw_data.freq']
+    if watermarks:
+        # incremental mode, only the data after the watermark of the device (minus the overlap) is read
+        ts_ini = read_start(watermarks, raw_cost_key(dev), ts_ini, freq['freq'])
     s = time.time()
     raw_data = source_config['raw_data'](**eval(source_config['raw_data_args']))
     logger.debug("time hbase", extra={'phase': "GATHER", "source": source_config['name'], "time": time.time() - s})
     if raw_data.empty:
         return pd.DataFrame()
     raw_data['timestamp'] = pd.to_datetime(raw_data['ts'].astype(int), unit="s")
-    raw_data['raw_conv_ratio'] = dev['raw_data.raw_unitConversionRatio']
-    raw_data['raw_conv_offset'] = dev['raw_data.raw_unitConversionOffset']
-    raw_data['harm_conv_ratio'] = dev['harmonized.harmonized_unitConversionRatio']
-    raw_data['harm_conv_offset'] = dev['harmonized.harmonized_unitConversionOffset']
-    raw_data['property'] = (dev['harmonized.property'].
-                            replace("https://bigg-project.eu/ontology#", "").
-                            replace("https://saref.etsi.org/core/", "").
-                            replace("https://www.beegroup-cimne.com/bee/ontology#", ""))
-    raw_data['value'] = raw_data.apply(source_config['value'], axis=1, args=(dev,))
+    # the values of the source are extracted and converted to the harmonized unit for whole columns at once
+    raw_data['value'] = source_config['values'](raw_data, dev)
     raw_data = raw_data.set_index('timestamp').sort_index().dropna(subset=['value'])
     if raw_data.empty:
         return pd.DataFrame()
@@ -351,36 +738,34 @@ def get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq):
     return raw_data
 
 
-def harmonize_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq):
-    raw_data = get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq)
+def harmonize_parts(dev, source_config, raw_data, freq, gap_check):
+    """
+    Harmonizes the raw data at `freq`, without joining the samples of the parts between gaps longer than
+    `gap_check` seconds. Data of regular tables is kept as it is.
+    """
+    table_freq = raw_data['freq'].unique()[0]
+    if table_freq:
+        return raw_data.copy()
+    # each sample gets the part it belongs to, the parts are harmonized together but never joined
+    segments = pd.Series(gap_segments(raw_data.index, gap_check), index=raw_data.index)
+    if source_config['pre_clean'] is not no_clean:
+        # the cleaning uses the statistics of each part, they are cleaned apart
+        raw_data = pd.concat([source_config['pre_clean'](df_h, dev) for _, df_h in raw_data.groupby(segments)])
+    raw_data = raw_data.dropna(subset=['value'])
+    if raw_data.empty:
+        return pd.DataFrame()
+    agg_func = dev['harmonized.aggregationFunction']
+    df_device_final = harmonize_irregular_data(raw_data, agg_func, freq, "value",
+                                               segments.reindex(raw_data.index).values)
+    return df_device_final if df_device_final is not None else pd.DataFrame()
+
+
+def harmonize_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq, raw_data=None):
+    if raw_data is None:
+        raw_data = get_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, freq)
     if raw_data.empty:
         return
-    table_freq = raw_data['freq'].unique()[0]
-    # check for big gaps to harmonize separately
-    start_index = raw_data.index.min() - pd.DateOffset(seconds=1)
-    parts = []
-    if freq['gap_check']:
-        check = raw_data.index.diff(1).fillna(pd.Timedelta(0)).total_seconds()
-        big_gap_index = raw_data.loc[check > freq['gap_check']].index
-        for end_idx in big_gap_index:
-            part = raw_data.loc[start_index:end_idx - pd.DateOffset(seconds=1)]
-            parts.append(part)
-            start_index = end_idx
-    parts.append(raw_data.loc[start_index:])
-    # deal with each part individually as they are continuous
-    df_device_final = pd.DataFrame()
-    if not table_freq:
-        for df_h in parts:
-            df_h = source_config['pre_clean'](df_h, dev)
-            df_h = df_h.dropna(subset=['value'])
-            if df_h.empty:
-                continue
-            agg_func = dev['harmonized.aggregationFunction']
-            df_tmp = harmonize_irregular_data(df_h, agg_func, freq['freq'], "value")
-            df_device_final = pd.concat([df_device_final, df_tmp])
-    else:
-        for df_h in parts:
-            df_device_final = pd.concat([df_device_final, df_h])
+    df_device_final = harmonize_parts(dev, source_config, raw_data, freq['freq'], freq['gap_check'])
     if df_device_final.empty:
         return
     df_device_final = source_config['post_clean'](df_device_final, dev)
@@ -389,8 +774,52 @@ def harmonize_raw_data(dev, source_config, hbase_connection, ts_ini, ts_end, fre
     return df_device_final
 
 
+def rollup_base_freq(freqs):
+    """
+    Frequency at which the data is harmonized to be rolled up to all the `freqs`. Months are not made of whole
+    weeks, so both are rolled up from days.
+    """
+    freqs = sorted(set(freqs), key=comparable_freq)
+    if freqs[0] == "P1W" and len(freqs) > 1:
+        return "P1D"
+    return freqs[0]
+
+
+def harmonize_rollup_data(dev, source_config, raw_data, windows, starts):
+    """
+    Harmonizes the raw data of a grouped device once at the finest frequency of its targets and rolls it up to the
+    rest. Frequencies with a different gap check are harmonized apart, as the gaps change their results. Returns
+    the (dev, data) of each target, with the data cleaned and cut from its start.
+    """
+    by_gap_check = {}
+    for target, start in zip(dev['targets'], starts):
+        by_gap_check.setdefault(windows[target['freq']]['freq']['gap_check'], []).append((target, start))
+    table_freq = raw_data['freq'].unique()[0]
+    results = []
+    for gap_check, targets in by_gap_check.items():
+        base_freq = rollup_base_freq([t['freq'] for t, _ in targets])
+        harmonized = harmonize_parts(dev, source_config, raw_data, base_freq, gap_check)
+        if harmonized.empty:
+            continue
+        for target, start in targets:
+            target_dev = dict(dev, **target)
+            df_device_final = harmonized
+            if not table_freq and target['freq'] != base_freq:
+                df_device_final = rollup_harmonized_data(harmonized, dev['harmonized.aggregationFunction'],
+                                                         base_freq, target['freq'], "value")
+            df_device_final = df_device_final.loc[pd.Timestamp(start.timestamp(), unit="s"):].copy()
+            if df_device_final.empty:
+                continue
+            df_device_final = source_config['post_clean'](df_device_final, target_dev)
+            days_to_overlap = windows[target['freq']]['freq']['days_to_overlap']
+            df_device_final = df_device_final.loc[
+                              df_device_final.index.min() + pd.DateOffset(days=days_to_overlap):]
+            results.append((target_dev, df_device_final))
+    return results
+
+
 def harmonize_calculation_devices(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
-                                  influx_connection, ts_ini, ts_end, freq, neo4j_connection):
+                                  influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements=None):
     """
     calculates the formula with the following schema:
     mo: operation (+ - * /)
@@ -437,7 +866,7 @@ def harmonize_calculation_devices(dev, druid_connection, druid_datasource, druid
     formula = f"<root>{formula}</root>"
     formula_tree = ElementTree.fromstring(formula)
     calculator = CalculateFunctions(druid_connection, druid_datasource, influx_connection, neo4j_connection,
-                                    druid_topic)
+                                    druid_topic, measurements)
     try:
         result = calculator.calculate_formula(formula_tree, ts_ini, ts_end, freq['freq'])
     except Exception as e:
@@ -461,7 +890,7 @@ def harmonize_calculation_devices(dev, druid_connection, druid_datasource, druid
 
 
 def harmonize_limits(dev, druid_connection, druid_datasource, druid_producer, druid_topic,
-                     influx_connection, ts_ini, ts_end, freq, neo4j_connection):
+                     influx_connection, ts_ini, ts_end, freq, neo4j_connection, measurements=None):
 
     lower_activation = ElementTree.fromstring(f"<root>{dev['lower__activation']}</root>")
     lower_formula = ElementTree.fromstring(f"<root>{dev['lower__formula']}</root>")
@@ -469,7 +898,7 @@ def harmonize_limits(dev, druid_connection, druid_datasource, druid_producer, dr
     upper_formula = ElementTree.fromstring(f"<root>{dev['upper__formula']}</root>")
 
     calculator = CalculateFunctions(druid_connection, druid_datasource, influx_connection, neo4j_connection,
-                                    druid_topic)
+                                    druid_topic, measurements)
     try:
         lower_activation_ts = calculator.calculate_formula(lower_activation, ts_ini, ts_end, freq['freq'])
         lower_formula_ts = calculator.calculate_formula(lower_formula, ts_ini, ts_end, freq['freq'])
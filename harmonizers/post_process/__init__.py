@@ -3,7 +3,10 @@ class Processor(object):
     name = None
 
     @staticmethod
-    def get_devices(frequency):
+    def get_devices():
+        """
+        Returns the query of the devices of the processor, with the frequency as the $freq parameter
+        """
         raise NotImplementedError
 
     @staticmethod
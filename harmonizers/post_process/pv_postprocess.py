@@ -11,15 +11,15 @@ class PVProcessor(Processor):
     name = "PVProcessor"
 
     @staticmethod
-    def get_devices(freq):
-        return f"""
+    def get_devices():
+        return """
                 Match(n:bigg__Patrimony)<-[:s4agri__isDeployedAtSpace]-(dp)<-[:ssn__hasDeployment]-(s:bigg__BuildingSystem)-
                 [:s4syst__hasSubSystem*..4]->(d:saref__Device)-[:saref__makesMeasurement]->(m:saref__Measurement)
-                WHERE m.bigg__measurementFrequency="{freq['freq']}"
+                WHERE m.bigg__measurementFrequency=$freq
                 Match(d)-[:saref__measuresProperty]->(p:saref__Property)
                 Where  dp.bigg__deploymentType="Electric" with n.bigg__idFromOrganization AS patrimony, 
-                [m in collect({{hash:m.bigg__hash, name:d.foaf__name, prop: p.uri, 
-                freq:m.bigg__measurementFrequency}})] AS devices return patrimony, devices
+                [m in collect({hash:m.bigg__hash, name:d.foaf__name, prop: p.uri, 
+                freq:m.bigg__measurementFrequency})] AS devices return patrimony, devices
             """
 
     @staticmethod
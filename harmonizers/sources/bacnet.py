@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 from lib2 import get_hbase_data, unit_conversion
 from lib2.clean_outliers import no_clean, znorm_clean
@@ -7,19 +8,19 @@ device_query = """
         MATCH (n:bigg__Patrimony)<-[:s4agri__isDeployedAtSpace]-(d:s4agri__Deployment)
                   <-[:ssn__hasDeployment]-(bsys)-[:s4syst__hasSubSystem*..]-
                   >(x)-[:saref__makesMeasurement]->(m:saref__Measurement)<-[:owl__sameAs]-(mc)<-[:saref__makesMeasurement]-(mcd:bee__BacnetDevice)
-        WHERE m.bigg__measurementFrequency = '{freq}'
+        WHERE m.bigg__measurementFrequency = $freq
         MATCH (m)-[:saref__isMeasuredIn]->(mmu)
         MATCH (m)-[:saref__relatesToProperty]->(mp)
         MATCH (mcd)-[:bigg__measuresIn]->(dmu)
-        WITH m,mmu, mp, {{gain: mcd.bee__gain,
+        WITH m,mmu, mp, {gain: mcd.bee__gain,
                           raw_unitConversionRatio:dmu.qudt__conversionMultiplier, 
                           raw_unitConversionOffset:dmu.qudt__conversionOffset, uri:mc.uri, 
-                          freq: coalesce(mc.bigg__measurementRawFrequency, ""), type:mcd.bee__bacnetType}} as mm
+                          freq: coalesce(mc.bigg__measurementRawFrequency, ""), type:mcd.bee__bacnetType} as mm
         RETURN  
-            DISTINCT {{property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency, 
+            DISTINCT {property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency, 
                       harmonized_unitConversionRatio:mmu.qudt__conversionMultiplier, 
                       harmonized_unitConversionOffset:mmu.qudt__conversionOffset, 
-                      aggregationFunction:mp.bigg__aggregationFunction}} as harmonized, collect(mm) as raw_data
+                      aggregationFunction:mp.bigg__aggregationFunction} as harmonized, collect(mm) as raw_data
         """
 
 
@@ -30,29 +31,24 @@ def __transform_type__(value, _type):
         return np.nan
 
 
-def get_bacnet_value(x, dev):
+def get_bacnet_values(raw_data, dev):
     """
     analog -> float
-    binary -> string
+    binary -> 1 (active) or 0 (inactive)
     multistate -> integer
     """
-
+    values = raw_data['value']
     if 'analog' in dev['raw_data.type']:
-        x['value'] = __transform_type__(x["value"], float)
-        return unit_conversion(x)
+        return unit_conversion(pd.to_numeric(values, errors="coerce"), dev)
 
     elif 'binary' in dev['raw_data.type']:
-        x['value'] = __transform_type__(x["value"], str)
-        if x.value == 'active':
-            return 1
-        elif x.value == 'inactive':
-            return 0
-        else:
-            return np.nan
+        return values.map({'active': 1, 'inactive': 0}).astype(float)
 
     elif 'multiState' in dev['raw_data.type']:
-        x['value'] = __transform_type__(x["value"], int)
-        return x.value
+        # int() rejects decimal strings, the states are few and parsed one by one
+        return values.map(lambda v: __transform_type__(v, int))
+
+    return pd.Series(np.nan, index=values.index)
 
 
 bacnet = {
@@ -64,7 +60,8 @@ bacnet = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "bacnet:timeseries_id_",
     "hbase": "hbase_infraestructures",
-    "value": get_bacnet_value,
+    "columns": ["value"],
+    "values": get_bacnet_values,
     "pre_clean": znorm_clean,
     "post_clean": no_clean
 }
@@ -5,52 +5,48 @@ device_query = """
     MATCH (n:bigg__Patrimony)<-[:s4agri__isDeployedAtSpace]-(d:s4agri__Deployment)
                   <-[:ssn__hasDeployment]-(bsys)-[:s4syst__hasSubSystem*..]-
                   >(x)-[:saref__makesMeasurement]->(m:saref__Measurement)<-[:owl__sameAs]-(mc)<-[:saref__makesMeasurement]-(mcd:bee__DexmaDevice)
-    WHERE m.bigg__measurementFrequency = '{freq}'
-    OPTIONAL MATCH (af:bee__AssetFeature{{foaf__name:"PotenciaNominal"}})<-[:bee__hasFeature]-
+    WHERE m.bigg__measurementFrequency = $freq
+    OPTIONAL MATCH (af:bee__AssetFeature{foaf__name:"PotenciaNominal"})<-[:bee__hasFeature]-
                (inst:s4bldg__BuildingObject)<-[:owl__sameAs]-(pv:bigg__PhotoVoltaic)-[:s4syst__hasSubSystem*..]-
                ()-[:saref__makesMeasurement]->(m)
     MATCH (m)-[:saref__isMeasuredIn]->(mmu)
     MATCH (m)-[:saref__relatesToProperty]->(mp)
     MATCH (mcd:bee__DexmaDevice)-[:bigg__measuresIn]->(dmu)
-        WITH m,mmu, mp, af, x, {{raw_unitConversionRatio:dmu.qudt__conversionMultiplier, 
+        WITH m,mmu, mp, af, x, {raw_unitConversionRatio:dmu.qudt__conversionMultiplier, 
                           raw_unitConversionOffset:dmu.qudt__conversionOffset, uri:mc.uri,
-                          freq: coalesce(mc.bigg__measurementRawFrequency, "")}} as mm
+                          freq: coalesce(mc.bigg__measurementRawFrequency, "")} as mm
         RETURN  
-            DISTINCT {{property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency, 
+            DISTINCT {property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency, 
                       max_power: af.saref__value, name:  x.foaf__name,
                       harmonized_unitConversionRatio:mmu.qudt__conversionMultiplier, 
                       harmonized_unitConversionOffset:mmu.qudt__conversionOffset, 
-                      aggregationFunction:mp.bigg__aggregationFunction}} as harmonized, collect(mm) as raw_data
+                      aggregationFunction:mp.bigg__aggregationFunction} as harmonized, collect(mm) as raw_data
         """
 
 project_query = """
        MATCH (n:bigg__Patrimony)<-[:s4agri__isDeployedAtSpace]-(d:s4agri__Deployment)
              <-[:ssn__hasDeployment]-(bsys:bigg__BuildingSystem)-[:s4syst__hasSubSystem*..]
              -(device:saref__Device)-[:saref__makesMeasurement]->(m)
-       WHERE (m:bigg__ExpectedMeasurement OR m:bigg__TargetMeasurement) AND m.bigg__measurementFrequency = '{freq}'
+       WHERE (m:bigg__ExpectedMeasurement OR m:bigg__TargetMeasurement) AND m.bigg__measurementFrequency = $freq
        MATCH (m)-[:saref__isMeasuredIn]->(mmu)
        MATCH (m)-[:saref__relatesToProperty]->(mp)
        MATCH (m)<-[:owl__sameAs]-(mc)<-[:saref__makesMeasurement]-(mcd:bee__DexmaProjectDevice)-[:bigg__measuresIn]->(dmu)
-       WITH device, m, mmu, mp, {{raw_unitConversionRatio:dmu.qudt__conversionMultiplier,
+       WITH device, m, mmu, mp, {raw_unitConversionRatio:dmu.qudt__conversionMultiplier,
                           raw_unitConversionOffset:dmu.qudt__conversionOffset, uri:mc.uri,
-                          freq: coalesce(mc.bigg__measurementRawFrequency, "")}} as mm        
+                          freq: coalesce(mc.bigg__measurementRawFrequency, "")} as mm        
        RETURN  
-           DISTINCT {{property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency,
+           DISTINCT {property: mp.uri, bigg__hash: m.bigg__hash, measurementFrequency:m.bigg__measurementFrequency,
                      name: device.foaf__name,
                      harmonized_unitConversionRatio:mmu.qudt__conversionMultiplier, 
                      harmonized_unitConversionOffset:mmu.qudt__conversionOffset, 
-                     aggregationFunction:mp.bigg__aggregationFunction}} as harmonized, collect(mm) as raw_data
+                     aggregationFunction:mp.bigg__aggregationFunction} as harmonized, collect(mm) as raw_data
    """
 
 
-def get_dexma_value(x, dev):
-    if "v" in x:
-        x['value'] = float(x.v)
-    if "target" in x:
-        x['value'] = float(x.target)
-    if "baseline" in x:
-        x['value'] = float(x.baseline)
-    return unit_conversion(x)
+def get_dexma_values(raw_data, dev):
+    # the last of the columns read wins
+    column = [c for c in ["v", "target", "baseline"] if c in raw_data.columns][-1]
+    return unit_conversion(raw_data[column].astype(float), dev)
 
 
 dexma = {
@@ -62,7 +58,8 @@ dexma = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "dexma:timeseries_id_",
     "hbase": "hbase_infraestructures",
-    "value": get_dexma_value,
+    "columns": ["v", "target", "baseline"],
+    "values": get_dexma_values,
     "pre_clean": no_clean,
     "post_clean": clean_instant_energy_data
 }
@@ -76,7 +73,8 @@ dexma_projects = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "dexma:timeseries_id_",
     "hbase": "hbase_infraestructures",
-    "value": get_dexma_value,
+    "columns": ["v", "target", "baseline"],
+    "values": get_dexma_values,
     "pre_clean": no_clean,
     "post_clean": no_clean,
 }
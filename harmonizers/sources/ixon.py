@@ -3,24 +3,23 @@ from lib2.clean_outliers import no_clean
 
 query_status = """
             MATCH (n:bee__IxonDevice)-[:saref__makesMeasurement]->(m:saref__Measurement)
-            WHERE m.bigg__measurementFrequency = '{freq}'
+            WHERE m.bigg__measurementFrequency = $freq
             MATCH (m)-[:saref__isMeasuredIn]->(mmu)
             MATCH (m)-[:saref__relatesToProperty]->(mp)
-            WITH m, mmu, mp, {{uu:mmu.uri, raw_unitConversionRatio:mmu.qudt__conversionMultiplier, 
+            WITH m, mmu, mp, {uu:mmu.uri, raw_unitConversionRatio:mmu.qudt__conversionMultiplier, 
             raw_unitConversionOffset: mmu.qudt__conversionOffset, 
-            uri:replace(m.uri, "%2B","+"), freq: coalesce(m.bigg__measurementRawFrequency, "")}} as mm
-            RETURN DISTINCT {{property: mp.uri, bigg__hash: m.bigg__hash, 
+            uri:replace(m.uri, "%2B","+"), freq: coalesce(m.bigg__measurementRawFrequency, "")} as mm
+            RETURN DISTINCT {property: mp.uri, bigg__hash: m.bigg__hash, 
                               measurementFrequency:m.bigg__measurementFrequency, uu:mmu.uri,
                               harmonized_unitConversionRatio:mmu.qudt__conversionMultiplier, 
                               harmonized_unitConversionOffset: mmu.qudt__conversionOffset,
-                              aggregationFunction:mp.bigg__aggregationFunction}} as harmonized, 
+                              aggregationFunction:mp.bigg__aggregationFunction} as harmonized, 
                               collect(DISTINCT mm) as raw_data
     """
 
 
-def get_ixon_value(x, dev):
-    x['value'] = int(x.status)
-    return int(unit_conversion(x))
+def get_ixon_values(raw_data, dev):
+    return unit_conversion(raw_data['status'].astype(int), dev).astype(int)
 
 
 ixon = {
@@ -32,7 +31,8 @@ ixon = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "ixon:timeseries_id_",
     "hbase": "hbase_infraestructures",
-    "value": get_ixon_value,
+    "columns": ["status"],
+    "values": get_ixon_values,
     "pre_clean": no_clean,
     "post_clean": no_clean
 }
@@ -12,54 +12,47 @@ from lib2.clean_outliers import no_clean
 indicators_query = """
     WITH ["https://www.beegroup-cimne.com/bee/ontology#TR", "https://www.beegroup-cimne.com/bee/ontology#IN", "https://www.beegroup-cimne.com/bee/ontology#RS"] as uri_eco
     MATCH (n:s4city__KeyPerformanceIndicatorAssessment)-[:s4city__quantifiesKPI]->(im:bee__IndicatorManttest)
-    WHERE not im.uri in uri_eco and n.bigg__measurementFrequency = '{freq}' and n.bigg__measurementRawFrequency is not null
+    WHERE not im.uri in uri_eco and n.bigg__measurementFrequency = $freq and n.bigg__measurementRawFrequency is not null
     MATCH (n)-[saref__isMeasuredIn]->(u:qudt__Unit)
-    WITH n, im, u, {{
+    WITH n, im, u, {
     raw_unitConversionRatio:u.qudt__conversionMultiplier, 
     raw_unitConversionOffset:u.qudt__conversionOffset, 
     uri:n.uri, 
-    freq: n.bigg__measurementRawFrequency}} as mm
-        RETURN DISTINCT {{property: im.uri, 
+    freq: n.bigg__measurementRawFrequency} as mm
+        RETURN DISTINCT {property: im.uri, 
     bigg__hash: n.bigg__hash,
     measurementFrequency:n.bigg__measurementFrequency,
     harmonized_unitConversionRatio:u.qudt__conversionMultiplier,
     harmonized_unitConversionOffset:u.qudt__conversionOffset, 
     aggregationFunction:im.bigg__aggregationFunction
-    }} as harmonized, collect(mm) as raw_data
+    } as harmonized, collect(mm) as raw_data
     """
 
 indicators_eco = """
     WITH ["https://www.beegroup-cimne.com/bee/ontology#TR", "https://www.beegroup-cimne.com/bee/ontology#IN", "https://www.beegroup-cimne.com/bee/ontology#RS"] as uri_eco
     MATCH (n:s4city__KeyPerformanceIndicatorAssessment)-[:s4city__quantifiesKPI]->(im:bee__IndicatorManttest)
-    WHERE im.uri in uri_eco and n.bigg__measurementFrequency = '{freq}' and n.bigg__measurementRawFrequency is not null
+    WHERE im.uri in uri_eco and n.bigg__measurementFrequency = $freq and n.bigg__measurementRawFrequency is not null
     MATCH (n)-[saref__isMeasuredIn]->(u:qudt__Unit)
-    WITH n, im, u, {{
+    WITH n, im, u, {
     raw_unitConversionRatio:u.qudt__conversionMultiplier, 
     raw_unitConversionOffset:u.qudt__conversionOffset, 
     uri:n.uri, 
-    freq: n.bigg__measurementRawFrequency}} as mm
-        RETURN DISTINCT {{property: im.uri, 
+    freq: n.bigg__measurementRawFrequency} as mm
+        RETURN DISTINCT {property: im.uri, 
     bigg__hash: n.bigg__hash,
     measurementFrequency:n.bigg__measurementFrequency,
     harmonized_unitConversionRatio:u.qudt__conversionMultiplier,
     harmonized_unitConversionOffset:u.qudt__conversionOffset, 
     aggregationFunction:im.bigg__aggregationFunction
-    }} as harmonized, collect(mm) as raw_data
+    } as harmonized, collect(mm) as raw_data
     """
 
 
-def get_manttest_value(x, dev):
-    try:
-        if "value" in x:
-            x['value'] = float(x.value)
-            return unit_conversion(x)
-        elif "import" in x:
-            x['value'] = float(x['import'])
-            return unit_conversion(x)
-        else:
-            return np.nan
-    except AttributeError as e:
-        return np.nan
+def get_manttest_values(raw_data, dev):
+    for column in ["value", "import"]:
+        if column in raw_data.columns:
+            return unit_conversion(raw_data[column].astype(float), dev)
+    return pd.Series(np.nan, index=raw_data.index)
 
 
 def get_hbase_data_manttest(hbase_connection, source, row_start, row_stop, dev, freq):
@@ -67,9 +60,10 @@ def get_hbase_data_manttest(hbase_connection, source, row_start, row_stop, dev,
                             dev=dev, freq=freq)
     if r_data.empty:
         return r_data
-    r_data['ts'] = pd.to_datetime(r_data.ts, unit="s").dt.tz_localize("UTC").dt.tz_convert("Europe/Madrid")
-    r_data['ts'] = r_data['ts'].apply(lambda x: x.replace(hour=0, minute=0, second=0, microsecond=0, day=1)) - pd.DateOffset(months=1)
-    r_data['ts'] = r_data['ts'].astype(int) // 10 ** 9
+    # the indicators of a month are stored at the beginning of the next one (in local time)
+    local = pd.to_datetime(r_data.ts, unit="s").dt.tz_localize("UTC").dt.tz_convert("Europe/Madrid")
+    month = (local.dt.tz_localize(None).dt.to_period("M") - 1).dt.to_timestamp()
+    r_data['ts'] = month.dt.tz_localize("Europe/Madrid").astype("int64") // 10 ** 9
     return r_data
 
 
@@ -89,7 +83,8 @@ manttest = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "manttest:timeseries_id_findindicators_",
     "hbase": "hbase_infraestructures",
-    "value": get_manttest_value,
+    "columns": ["value", "import"],
+    "values": get_manttest_values,
     "pre_clean": remove_month_duplicates,
     "post_clean": no_clean
 }
@@ -103,7 +98,8 @@ manttest_eco = {
                          'row_stop': ts_end, 'freq': reg_freq}""",
     "table": "manttest:timeseries_id_economic_",
     "hbase": "hbase_infraestructures",
-    "value": get_manttest_value,
+    "columns": ["value", "import"],
+    "values": get_manttest_values,
     "pre_clean": no_clean,
     "post_clean": no_clean
 }
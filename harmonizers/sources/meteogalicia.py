@@ -10,40 +10,39 @@ query_stations = """
                   <-[:ssn__hasDeployment]-(bsys)-[:s4syst__hasSubSystem*..]->(x)-[:saref__makesMeasurement]->
                   (m:saref__Measurement)<-[:owl__sameAs]-(mc)<-[:saref__makesMeasurement]-(mcd)
                   <-[:s4syst__hasSubSystem]-(ws:bee__MeteoGalicia)
-            WHERE m.bigg__measurementFrequency = '{freq}'
+            WHERE m.bigg__measurementFrequency = $freq
             MATCH (m)-[:saref__isMeasuredIn]->(mmu)
             MATCH (m)-[:saref__relatesToProperty]->(mp)
             MATCH (mcd)-[:bigg__measuresIn]->(dmu)
-            WITH m,mmu, mp, {{uu:dmu.uri, raw_unitConversionRatio:dmu.qudt__conversionMultiplier, 
+            WITH m,mmu, mp, {uu:dmu.uri, raw_unitConversionRatio:dmu.qudt__conversionMultiplier, 
                               raw_unitConversionOffset: dmu.qudt__conversionOffset, 
                               uri:ws.geo__latitude + "~" + ws.geo__longitude,
                               lat: ws.geo__latitude, lon: ws.geo__longitude, 
-                              freq: coalesce(mc.bigg__measurementRawFrequency, "")}} as mm
+                              freq: coalesce(mc.bigg__measurementRawFrequency, "")} as mm
             RETURN  
-                DISTINCT {{property: mp.uri, bigg__hash: m.bigg__hash, 
+                DISTINCT {property: mp.uri, bigg__hash: m.bigg__hash, 
                            measurementFrequency:m.bigg__measurementFrequency, uu:mmu.uri,
                           harmonized_unitConversionRatio:mmu.qudt__conversionMultiplier, 
                           harmonized_unitConversionOffset: mmu.qudt__conversionOffset,
-                          aggregationFunction:mp.bigg__aggregationFunction}} as harmonized, 
+                          aggregationFunction:mp.bigg__aggregationFunction} as harmonized, 
                         collect(DISTINCT mm) as raw_data
     """
 
 
-def wm2_to_whm2(x):
-    x['raw_conv_ratio'] = 3600
-    return x
+# field and raw unit ratio of each property, the radiation is given in W/m2 and harmonized as Wh/m2
+property_map = {
+    "Temperature": {"field": "airTemperature", "raw_ratio": None},
+    "GlobalNormalRadiation": {"field": "GHI", "raw_ratio": 3600},
+    "Pressure": {"field": "atmosphericPressure", "raw_ratio": None}
+}
 
 
-def get_meteogalicia_value(x, dev):
-    property_map = {
-        "Temperature": {"field": "airTemperature", "conv": None},
-        "GlobalNormalRadiation": {"field": "GHI", "conv": wm2_to_whm2},
-        "Pressure": {"field": "atmosphericPressure", "conv": None}
-    }
-    x['value'] = float(x[property_map[x['property']]['field']])
-    if property_map[x['property']]['conv']:
-        x = property_map[x['property']]['conv'](x)
-    return unit_conversion(x)
+def get_meteogalicia_values(raw_data, dev):
+    prop = (dev['harmonized.property'].
+            replace("https://bigg-project.eu/ontology#", "").
+            replace("https://saref.etsi.org/core/", "").
+            replace("https://www.beegroup-cimne.com/bee/ontology#", ""))
+    return unit_conversion(raw_data[property_map[prop]['field']].astype(float), dev, property_map[prop]['raw_ratio'])
 
 
 def get_meteogalicia(dev, ts_ini, ts_end, source_config, hbase_connection):
@@ -67,7 +66,7 @@ meteogalicia = {
     "raw_data_args": """{'ts_ini': ts_ini, 'ts_end': ts_end, 'dev': dev,
                      'source_config': source_config, 'hbase_connection': hbase_connection}""",
     "hbase": "hbase_meteo",
-    "value": get_meteogalicia_value,
+    "values": get_meteogalicia_values,
     "pre_clean": no_clean,
     "post_clean": no_clean
 }
@@ -0,0 +1,162 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+from lib2.pipeline import prefetch
+from lib2.redis_queue import claim_devices, report_costs, start_lease, processing_key, ack_devices, take_over, \
+    load_catalog
+from lib2.redis_sync import arrive, wait_released, take_gate, wait_gates
+
+logger = logging.getLogger(__name__)
+
+# seconds without heartbeat after which a worker is considered lost and its devices are taken over
+LEASE_TTL = 60
+
+
+def create_stage(name, redis_base, deps, process, dev_log=None, cost=None, fetch=None, sender=None, gated=False):
+    """
+    A stage is a redis queue of devices processed with `process(dev)`. A stage can only start when all the stages
+    in `deps` have been completed by all the workers. `cost` is a tuple with the redis key of the cost history
+    and the function giving the key of a device in it; `process` may return the number of rows of the device.
+    When `fetch(dev)` is given, it is run ahead in background and its future is passed to `process` as `fetched`.
+    When the stage sends its data with a `sender`, devices are only acknowledged once their data has been sent.
+    A `gated` stage is published while the workers run, it is only drained once the gate of its barrier is opened.
+    """
+    return {"name": name, "redis": redis_base, "deps": [d['redis'] for d in deps], "process": process,
+            "dev_log": dev_log if dev_log else lambda x: x, "cost": cost, "fetch": fetch, "sender": sender,
+            "gated": gated}
+
+
+def create_worker(redis_conn, redis_base):
+    """
+    Registers the worker of the run and keeps its lease alive while it runs.
+    """
+    worker = {"id": f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}", "redis": redis_base}
+    worker['stop'] = start_lease(redis_conn, f"{redis_base}.lease.{worker['id']}", LEASE_TTL)
+    redis_conn.sadd(f"{redis_base}.workers", worker['id'])
+    return worker
+
+
+def stop_worker(redis_conn, worker):
+    redis_conn.srem(f"{worker['redis']}.workers", worker['id'])
+    worker['stop'].set()
+
+
+def process_devices(redis_conn, stage, devices, worker, done, prefetch_depth, max_bytes):
+    """
+    Processes the (dev, queue_len, item) tuples of a stage, adding the items to `done` once they are processed
+    and their data sent. Returns the costs of the devices.
+    """
+    costs = []
+    sent = []
+    sender = stage['sender']
+    if stage['fetch']:
+        devices = prefetch(devices, lambda x: stage['fetch'](x[0]), prefetch_depth, max_bytes)
+    else:
+        devices = ((x, None) for x in devices)
+    for (dev, queue_len, item), fetched in devices:
+        logger.debug("Processing from", extra={'phase': "GATHER", "source": stage['name'], "len": queue_len,
+                                               "dev": stage['dev_log'](dev)})
+        s = time.time()
+        rows = stage['process'](dev, fetched=fetched) if fetched is not None else stage['process'](dev)
+        if stage['cost']:
+            costs.append((stage['cost'][1](dev), time.time() - s, rows or 0))
+        sent.append((item, sender.submitted if sender else 0))
+        while sent and sent[0][1] <= (sender.completed if sender else 0):
+            done.append(sent.pop(0)[0])
+    if sender:
+        for e in sender.join():
+            logger.error("Failed to send", extra={'phase': "GATHER", "source": stage['name'], "error": str(e)})
+    done.extend([x[0] for x in sent])
+    ack_devices(redis_conn, processing_key(stage['redis'], worker['id']), done)
+    del done[:]
+    return costs
+
+
+def drain_stage(redis_conn, stage, num_processors, worker, prefetch_depth, max_bytes):
+    logger.debug("Processing from", extra={'phase': "GATHER", "source": stage['name']})
+    done = []
+    devices = claim_devices(redis_conn, stage['redis'], num_processors, worker['id'], done)
+    costs = process_devices(redis_conn, stage, devices, worker, done, prefetch_depth, max_bytes)
+    if costs:
+        report_costs(redis_conn, stage['cost'][0], costs)
+
+
+def reap_workers(redis_conn, stages, num_processors, worker):
+    """
+    Takes over the devices leased by the workers whose lease has expired, and arrives at their stages on their
+    behalf once their devices are processed so the rest of workers are not blocked by them.
+    """
+    workers_key = f"{worker['redis']}.workers"
+    for lost in [w.decode() for w in redis_conn.smembers(workers_key)]:
+        if lost == worker['id'] or redis_conn.exists(f"{worker['redis']}.lease.{lost}"):
+            continue
+        if not redis_conn.srem(workers_key, lost):
+            # another worker is already taking it over
+            continue
+        logger.warning("Worker lost", extra={'phase': "GATHER", "worker": lost})
+        for stage in stages:
+            items = take_over(redis_conn, stage['redis'], lost, worker['id'])
+            if items:
+                logger.warning("Processing devices of lost worker", extra={'phase': "GATHER", "worker": lost,
+                                                                          "source": stage['name'],
+                                                                          "devices": len(items)})
+                catalog = load_catalog(redis_conn, stage['redis'])
+                process_devices(redis_conn, stage, [(catalog[int(i)], 0, i) for i in items], worker, [], 1, 0)
+            arrive(redis_conn, stage['redis'], num_processors, lost)
+
+
+def run_stages(redis_conn, stages, num_processors, time_min, worker, prefetch_depth=1, max_bytes=256 * 1024 * 1024,
+               more_stages=None):
+    """
+    Processes the stages, given in topological order. The worker drains every stage whose dependencies are
+    completed and whose gate is open, and only blocks when all the remaining stages are not published yet or
+    depend on a stage not finished by the other workers. While blocked on the other workers, it takes over the
+    work of the lost workers. `more_stages()` is called once the given stages have been drained and returns the
+    stages that depend on them but can't be built until their devices are published.
+    """
+    stages = list(stages)
+    arrived = set()
+    done = set()
+    opened = set()
+
+    def on_idle():
+        # lost workers are only taken over once all the stages are known, to arrive at all of them on their behalf
+        if more_stages is None:
+            reap_workers(redis_conn, stages, num_processors, worker)
+
+    while True:
+        for stage in stages:
+            if stage['redis'] in arrived or not all(d in done for d in stage['deps']):
+                continue
+            if stage['gated'] and stage['redis'] not in opened:
+                if not take_gate(redis_conn, stage['redis']):
+                    continue
+                opened.add(stage['redis'])
+            drain_stage(redis_conn, stage, num_processors, worker, prefetch_depth, max_bytes)
+            arrive(redis_conn, stage['redis'], num_processors, worker['id'])
+            arrived.add(stage['redis'])
+        pending = [s for s in stages if s['redis'] not in arrived]
+        if not pending:
+            if more_stages is None:
+                break
+            stages.extend(more_stages())
+            more_stages = None
+            continue
+        closed = [s['redis'] for s in pending if s['gated'] and s['redis'] not in opened and
+                  all(d in done for d in s['deps'])]
+        if closed:
+            opened.add(wait_gates(redis_conn, closed, time_min))
+            continue
+        # the first pending stage in topological order has all its dependencies drained by this worker
+        wait_stages(redis_conn, [d for d in pending[0]['deps'] if d not in done], time_min, on_idle)
+        done.update(pending[0]['deps'])
+    wait_stages(redis_conn, [s['redis'] for s in stages if s['redis'] not in done], time_min, on_idle)
+
+
+def wait_stages(redis_conn, redis_bases, time_min, on_idle=None):
+    for redis_base in redis_bases:
+        wait = wait_released(redis_conn, redis_base, time_min, on_idle)
+        logger.debug("All sync", extra={'phase': "GATHER", "source": f"{redis_base}.semaphore", "wait": wait})
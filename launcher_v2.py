@@ -8,6 +8,7 @@ import warnings
 import pytz
 
 from harmonizers import starter_job, processor_job
+from lib2.time_buckets import comparable_freq
 import logging
 from pythonjsonlogger import jsonlogger
 
@@ -19,12 +20,19 @@ logHandler.setFormatter(formatter)
 logger.addHandler(logHandler)
 warnings.filterwarnings("ignore")
 
+# watermark_overlap: seconds read again before the watermark in incremental mode, to complete the last buckets and
+# get the late data
 FREQ_CONFIG = {
-    "PT15M": {"freq": "PT15M", 'days_to_gather': 7, 'days_to_overlap': 0, "gap_check": 3600 * 2},
-    "PT1H": {"freq": "PT1H", 'days_to_gather': 7, 'days_to_overlap': 0, "gap_check": 3600 * 2},
-    "P1D": {"freq": "P1D", 'days_to_gather': 60, 'days_to_overlap': 0, "gap_check": None},
-    "P1W": {"freq": "P1W", 'days_to_gather': 60, 'days_to_overlap': 0, "gap_check": None},
-    "P1M": {"freq": "P1M", 'days_to_gather': 180, 'days_to_overlap': 0, "gap_check": None}
+    "PT15M": {"freq": "PT15M", 'days_to_gather': 7, 'days_to_overlap': 0, "gap_check": 3600 * 2,
+              "watermark_overlap": 3600 * 6},
+    "PT1H": {"freq": "PT1H", 'days_to_gather': 7, 'days_to_overlap': 0, "gap_check": 3600 * 2,
+             "watermark_overlap": 3600 * 12},
+    "P1D": {"freq": "P1D", 'days_to_gather': 60, 'days_to_overlap': 0, "gap_check": None,
+            "watermark_overlap": 3600 * 24 * 3},
+    "P1W": {"freq": "P1W", 'days_to_gather': 60, 'days_to_overlap': 0, "gap_check": None,
+            "watermark_overlap": 3600 * 24 * 14},
+    "P1M": {"freq": "P1M", 'days_to_gather': 180, 'days_to_overlap': 0, "gap_check": None,
+            "watermark_overlap": 3600 * 24 * 62}
 }
 
 
@@ -36,10 +44,26 @@ if __name__ == '__main__':
     ap.add_argument('--diff', '-d', required=False, default="")
     ap.add_argument("--actions", "-a", required=False, nargs="+", default=["raw", "processors", "calculations", "limits"])
     ap.add_argument("--topic", "-t", required=False, default="icatprod.druid")
-    ap.add_argument('--frequency', '-f', required=True)
+    ap.add_argument('--frequency', '-f', required=True, nargs="+",
+                    help="frequencies of the run, the raw data of several frequencies is read once at the finest one")
     ap.add_argument('--start', '-s', required=False, default=None)
     ap.add_argument('--stop', '-p', required=False, default=None)
-    ap.add_argument('--processors', '-n', required=False, default=4)
+    ap.add_argument('--processors', '-n', required=False, default=4,
+                    help="total number of workers of the run, adding the workers of all the processor pods")
+    ap.add_argument('--workers', '-w', required=False, default=1, help="number of worker processes of this pod")
+    ap.add_argument('--prefetch', required=False, default=4, help="raw devices read in advance by each worker")
+    ap.add_argument('--max-inflight-mb', required=False, default=256,
+                    help="memory budget of each worker, split in thirds between the prefetched data, the hbase "
+                         "scans kept for the next devices and the pending kafka messages")
+    ap.add_argument('--incremental', '-i', required=False, action="store_true",
+                    help="read the raw data of each device only from its watermark, within the days_to_gather window")
+    ap.add_argument('--query-cache-ttl', required=False, default=3600,
+                    help="seconds the results of the device queries are reused by the starter, 0 to disable")
+    ap.add_argument('--refresh-devices', required=False, action="store_true",
+                    help="invalidate the cached device queries before starting")
+    ap.add_argument('--raw-cache', required=False, default=None,
+                    help="folder to keep the raw data of the closed days read from hbase, for backfills")
+    ap.add_argument('--raw-cache-gb', required=False, default=20, help="size of the raw data cache")
 
     if (os.getenv("PYCHARM_HOSTED_IGNORE") is None or os.getenv("PYCHARM_HOSTED_IGNORE") == 0) and os.getenv("PYCHARM_HOSTED") is not None:
         args = ap.parse_args(["-l", "processor", "-f", "PT15M",  "-n", "10", "-s",
@@ -52,15 +76,21 @@ if __name__ == '__main__':
             row_stop = datetime.datetime.fromisoformat(args.stop)
         else:
             row_stop = datetime.datetime.now(pytz.timezone("Europe/Madrid"))
-        if args.start is not None:
-            row_start = datetime.datetime.fromisoformat(args.start)
-        else:
-            row_start = row_stop - datetime.timedelta(days=FREQ_CONFIG[args.frequency]['days_to_gather'])
+        freqs = sorted(set(args.frequency), key=comparable_freq)
+        row_starts = []
+        for f in freqs:
+            if args.start is not None:
+                row_starts.append(datetime.datetime.fromisoformat(args.start))
+            else:
+                row_starts.append(row_stop - datetime.timedelta(days=FREQ_CONFIG[f]['days_to_gather']))
+        row_start = row_starts[0]
+        rollup_freqs = [(FREQ_CONFIG[f], r) for f, r in zip(freqs[1:], row_starts[1:])]
 
         if args.launcher == 'start':
             starter_job(neo4j_connection=config['neo4j'], redis_connection=config['redis']['connection'],
-                        freq=FREQ_CONFIG[args.frequency], diff=args.diff, num_processors=int(args.processors),
-                        actions=args.actions
+                        freq=FREQ_CONFIG[freqs[0]], diff=args.diff, num_processors=int(args.processors),
+                        actions=args.actions, rollup_freqs=[f for f, _ in rollup_freqs],
+                        query_cache_ttl=int(args.query_cache_ttl), refresh_devices=args.refresh_devices
                         )
         elif args.launcher == 'processor':
             processor_job(redis_connection=config['redis']['connection'], hbase_connection=config['hbase'],
@@ -68,6 +98,10 @@ if __name__ == '__main__':
                           druid_connection=config['druid']['connection'],
                           druid_topic=args.topic, druid_datasource=config['druid']['datasource'],
                           influx_connection=config['influx'],
-                          ts_ini=row_start, ts_end=row_stop, freq=FREQ_CONFIG[args.frequency], diff=args.diff,
-                          num_processors=int(args.processors), actions=args.actions)
+                          ts_ini=row_start, ts_end=row_stop, freq=FREQ_CONFIG[freqs[0]], diff=args.diff,
+                          num_processors=int(args.processors), actions=args.actions, workers=int(args.workers),
+                          prefetch=int(args.prefetch), max_inflight_bytes=int(args.max_inflight_mb) * 1024 * 1024,
+                          incremental=args.incremental, rollup_freqs=rollup_freqs,
+                          raw_cache={"path": args.raw_cache, "max_bytes": int(args.raw_cache_gb) * 1024 ** 3}
+                          if args.raw_cache else None)
 
@@ -1,54 +1,245 @@
-import beelib
+import json
+from functools import partial
+
 import numpy as np
 import pandas as pd
 
+from lib2.hbase import get_tables, scan_batches, shared_scan
+from lib2.raw_cache import get_raw_cache, cached_rows
+from lib2.time_buckets import bucket_ends, bucket_ids, bucket_index, bucket_starts, covering_edges
 
-def get_hbase_data(hbase_connection, source, dev, row_start=None, row_stop=None, freq=None):
-    row_start = f"{dev['raw_data.uri']}~{int(row_start.timestamp())}"
-    row_stop = f"{dev['raw_data.uri']}~{int(row_stop.timestamp())}"
-    tables = beelib.beehbase.get_tables(source['table'] + freq+"$", hbase_connection[source['hbase']]['connection'])
-    df_raw = pd.DataFrame()
-    for table in tables:
+
+def create_hbase_columns():
+    """
+    Columns of the rows of hbase being decoded: the uri and epoch of their key, the frequency of their table, and
+    for each qualifier the positions of the rows that have it and their values.
+    """
+    return {"uri": [], "ts": [], "freq": [], "values": {}, "names": {}, "uris": {}}
+
+
+def decode_hbase_rows(columns, data, table_freq):
+    """
+    Adds the (key, row) pairs of a batch, with keys "<uri>~<ts>" and qualifiers "<family>:<name>", to `columns`.
+    The key parts and the qualifier names are only decoded once.
+    """
+    uris, names, values = columns['uris'], columns['names'], columns['values']
+    pos = len(columns['ts'])
+    for key, row in data:
+        uri, _, ts = key.rpartition(b"~")
+        if uri not in uris:
+            uris[uri] = uri.decode("utf-8")
+        columns['uri'].append(uris[uri])
+        columns['ts'].append(int(ts))
+        for k, v in row.items():
+            if k not in names:
+                names[k] = k.decode("utf-8").split(":")[1]
+                values.setdefault(names[k], ([], []))
+            rows, vals = values[names[k]]
+            if rows and rows[-1] == pos:
+                # qualifiers of different families with the same name, the last one is kept
+                vals[-1] = v.decode("utf-8")
+                continue
+            rows.append(pos)
+            vals.append(v.decode("utf-8"))
+        pos += 1
+    columns['freq'].extend([table_freq] * (pos - len(columns['freq'])))
+
+
+def hbase_columns_to_df(columns):
+    """
+    Builds the dataframe of the decoded rows, with an int64 `ts` and the values missing in a row as NaN
+    """
+    size = len(columns['ts'])
+    if not size:
+        return pd.DataFrame()
+    df = {"uri": columns['uri'], "ts": np.array(columns['ts'], dtype=np.int64), "freq": columns['freq']}
+    for name, (rows, vals) in columns['values'].items():
+        if len(rows) == size:
+            df[name] = vals
+        else:
+            col = np.full(size, np.nan, dtype=object)
+            col[rows] = vals
+            df[name] = col
+    return pd.DataFrame(df)
+
+
+def _scan_hbase_(server, source, freq, row_start, row_stop):
+    columns = create_hbase_columns()
+    for table in get_tables(server, source['table'] + freq + "$"):
         table_freq = table.split('_')[-1] if table.split('_')[-1] != 'time' else None
-        for data in beelib.beehbase.get_hbase_data_batch(hbase_connection[source['hbase']]['connection'],
-                                                         table, row_start=row_start, row_stop=row_stop):
-            items = []
-            for key, row in data:
-                dev_info, ts = key.decode("utf-8").split("~")
-                item = {'uri': dev_info, 'ts': int(ts), 'freq': table_freq}
-                for k, v in row.items():
-                    item[k.decode("utf-8").split(":")[1]] = v.decode("utf")
-                items.append(item)
-            df_raw = pd.concat([df_raw, pd.DataFrame(items)], ignore_index=True)
-    return df_raw
-
-
-def harmonize_irregular_data(df, agg_func, freq, value_column):
+        for data in scan_batches(server, table, row_start=row_start, row_stop=row_stop,
+                                 columns=source.get('columns')):
+            decode_hbase_rows(columns, data, table_freq)
+    return hbase_columns_to_df(columns)
+
+
+def get_hbase_data(hbase_connection, source, dev, row_start=None, row_stop=None, freq=None):
+    """
+    Reads the raw data of the device from the tables of the source for the frequency. When the source gives its
+    "columns", only those are read. The devices reading the same rows at the same time share the scan, and with
+    the raw cache configured the closed days are read from the local cache.
+    """
+    uri = dev['raw_data.uri']
+    server = hbase_connection[source['hbase']]['connection']
+    key = (json.dumps(server, sort_keys=True, default=str), source['table'] + freq, uri,
+           tuple(source.get('columns') or ()))
+
+    def read(start, end):
+        return shared_scan(key + (start, end), partial(_scan_hbase_, server, source, freq, f"{uri}~{start}",
+                                                       f"{uri}~{end}"))
+
+    cache = get_raw_cache()
+    if cache:
+        return cached_rows(cache, key, int(row_start.timestamp()), int(row_stop.timestamp()), read)
+    return read(int(row_start.timestamp()), int(row_stop.timestamp())).copy()
+
+
+def gap_segments(index, gap_check):
+    """
+    Returns the segment of each timestamp of the sorted index, a new segment starts after each gap longer than
+    `gap_check` seconds. Without `gap_check` all the timestamps are in segment 0.
+    """
+    if not gap_check or len(index) == 0:
+        return np.zeros(len(index), dtype=np.int64)
+    gaps = np.diff(_seconds_(index)) > gap_check
+    return np.concatenate([[0], np.cumsum(gaps)])
+
+
+def _line_buckets_(ts, values, segments, edges, agg_func):
+    """
+    Returns the start (s) of the buckets fully covered by a segment of the samples at the seconds `ts`, and the SUM
+    or AVG of the line joining the samples of the segment in each of them, as if the line were sampled at each
+    second: SUM is the increase between the seconds before the start and the end of the bucket, only given when
+    the line never decreases in it, and AVG is the mean of the line at the seconds of the bucket. The line is never
+    joined across segments. `edges` are the starts of the buckets and the end of the last one, covering the
+    samples. The line is split at the samples and the edges, so the cost is O(samples + buckets).
+    """
+    # the increase of each second comes from the second before, so the buckets of SUM start one second earlier
+    shift = 1 if agg_func == "SUM" else 0
+    last_of_segment = np.append(segments[1:] != segments[:-1], True)
+    seg_first, seg_last = ts[np.append(True, last_of_segment[:-1])], ts[last_of_segment]
+    # the mean includes the last sample of each segment, as a one second piece
+    ends = seg_last[-1:] if agg_func == "SUM" else seg_last + 1
+    end = ends[-1]
+    shifted = edges - shift
+    points = np.union1d(np.append(ts, ends), shifted[(shifted > ts[0]) & (shifted < end)])
+    if len(points) < 2:
+        return np.array([], dtype=np.int64), np.array([])
+    p, q = points[:-1], points[1:]
+    # pieces between two samples of the same segment, or the last second of a segment for the mean
+    sample = np.searchsorted(ts, p, side="right") - 1
+    joined = np.append(segments[1:] == segments[:-1], False)[sample]
+    if agg_func == "AVG":
+        joined |= last_of_segment[sample] & (p == ts[sample])
+    p, q = p[joined], q[joined]
+    vp, vq = np.interp(p, ts, values), np.interp(q, ts, values)
+    bucket = np.searchsorted(shifted, p, side="right") - 1
+    n_buckets = len(edges) - 1
+    starts, lengths = edges[:-1], np.diff(edges)
+    # a bucket is covered when the segment of its first second reaches its last one
+    covering = np.maximum(np.searchsorted(seg_first, starts - shift, side="right") - 1, 0)
+    if agg_func == "SUM":
+        delta = vq - vp
+        result = np.bincount(bucket, weights=delta, minlength=n_buckets)
+        decreases = np.bincount(bucket, weights=delta < 0, minlength=n_buckets) > 0
+        complete = (starts - 1 >= ts[0]) & (starts - 1 + lengths <= seg_last[covering]) & ~decreases
+    else:
+        d = q - p
+        result = np.bincount(bucket, weights=d * vp + (vq - vp) * (d - 1) / 2, minlength=n_buckets) / lengths
+        complete = (starts >= ts[0]) & (starts + lengths <= seg_last[covering] + 1)
+    return starts[complete], result[complete]
+
+
+def _segments_last_(values, segments, edges):
+    """
+    LAST of the values in each bucket of `edges`, filled forward in the buckets of each segment without values
+    """
+    last = values.groupby([segments, bucket_ids(values.index, edges)]).last()
+    seg, ids = last.index.get_level_values(0), last.index.get_level_values(1)
+    bounds = pd.Series(ids).groupby(seg.values).agg(["min", "max"])
+    counts = (bounds['max'] - bounds['min'] + 1).values
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    full = pd.MultiIndex.from_arrays([np.repeat(bounds.index.values, counts),
+                                      np.repeat(bounds['min'].values, counts) + offsets])
+    return last.reindex(full).groupby(level=0).ffill()
+
+
+def _seconds_(index):
+    return index.values.astype("datetime64[s]").astype(np.int64)
+
+
+def harmonize_irregular_data(df, agg_func, freq, value_column, segments=None):
+    """
+    Harmonizes the irregular samples of `df` into the buckets of `freq`, fixed (PT15M, PT1H, P1D) or calendar
+    (P1W, P1M). With `segments` (see gap_segments), the samples of different segments are never joined, all the
+    segments are harmonized in one pass. The bucket edges come from the grid of the months of the data, shared by
+    the devices.
+    """
+    values = df[value_column]
+    segments = np.zeros(len(values), dtype=np.int64) if segments is None else np.asarray(segments)
+    if agg_func == "LAST":
+        edges = covering_edges(values.index[0], values.index[-1], freq)
+        last = _segments_last_(values, segments, edges)
+        return pd.DataFrame({value_column: last.values},
+                            index=pd.DatetimeIndex(edges[last.index.get_level_values(1)], name=df.index.name))
+    elif agg_func not in ("SUM", "AVG"):
+        return None
+    if agg_func == "SUM":
+        remove_neg = values.diff() < 0
+        # the first sample of each segment has no previous one
+        remove_neg &= np.append(False, segments[1:] == segments[:-1])
+        values, segments = values[~remove_neg], segments[~remove_neg.values]
+    # the samples are at whole seconds, as read from hbase
+    ts = _seconds_(values.index)
+    shift = 1 if agg_func == "SUM" else 0
+    edges = _seconds_(covering_edges(pd.Timestamp(ts[0] + shift, unit="s"), pd.Timestamp(ts[-1] + 1, unit="s"), freq))
+    starts, result = _line_buckets_(ts, values.to_numpy(dtype=float), segments, edges, agg_func)
+    index = pd.DatetimeIndex(pd.to_datetime(starts, unit="s"), name=df.index.name)
+    return pd.DataFrame({value_column: result}, index=index)
+
+
+def rollup_harmonized_data(df, agg_func, from_freq, freq, value_column):
+    """
+    Aggregates data harmonized at `from_freq` into the coarser `freq`, which must be made of whole `from_freq`
+    buckets. SUM and AVG are only given for the buckets with all their `from_freq` buckets, so the result is the
+    same as harmonizing the raw data at `freq`. Weeks start on monday and months are calendar months.
+    """
+    values = df[value_column]
+    grouped = values.groupby(bucket_starts(values.index, freq))
+    if agg_func == "LAST":
+        return pd.DataFrame(grouped.last())
+    starts = grouped.size().index
+    expected = (bucket_ends(starts, freq) - starts) / pd.Timedelta(from_freq)
+    complete = grouped.count().values == expected
     if agg_func == "SUM":
-        remove_neg = df[value_column].diff() < 0
-        df = df[~remove_neg]
-        df_resampled_total = df[value_column].resample('1s').mean().interpolate(method='linear')
-        df_resampled_diff = df_resampled_total.diff()
-        df_resampled_diff = df_resampled_diff[df_resampled_diff >= 0]
-        df_resampled_count = df_resampled_diff.resample(pd.Timedelta(freq)).count()
-        df_resampled_sum = df_resampled_diff.resample(pd.Timedelta(freq)).sum()
-        return pd.DataFrame(df_resampled_sum[df_resampled_count == pd.Timedelta(freq).total_seconds()])
+        return pd.DataFrame(grouped.sum()[complete])
     elif agg_func == "AVG":
-        df_resampled_total = df[value_column].resample('1s').mean().interpolate(method="linear")
-        df_resampled_count = df_resampled_total.resample(pd.Timedelta(freq)).count()
-        df_resampled_avg = df_resampled_total.resample(pd.Timedelta(freq)).mean()
-        return pd.DataFrame(df_resampled_avg[df_resampled_count == pd.Timedelta(freq).total_seconds()])
-    elif agg_func == "LAST":
-        return pd.DataFrame(df[value_column].resample(pd.Timedelta(freq)).last().ffill())
+        return pd.DataFrame(grouped.mean()[complete])
+
+
+def _conversion_factor_(value, default):
+    return float(value) if value and not np.isnan(value) else default
+
+
+def conversion_affine(dev, raw_ratio=None):
+    """
+    Returns the (scale, offset) converting the raw values of the device to its harmonized unit as
+    raw * scale + offset. Missing or 0 ratios and offsets are not applied, `raw_ratio` replaces the ratio of the
+    raw unit.
+    """
+    raw_conv_r = _conversion_factor_(dev['raw_data.raw_unitConversionRatio'] if raw_ratio is None else raw_ratio, 1)
+    harm_conv_r = _conversion_factor_(dev['harmonized.harmonized_unitConversionRatio'], 1)
+    raw_conv_o = _conversion_factor_(dev['raw_data.raw_unitConversionOffset'], 0)
+    harm_conv_o = _conversion_factor_(dev['harmonized.harmonized_unitConversionOffset'], 0)
+    return raw_conv_r / harm_conv_r, raw_conv_o - harm_conv_o
 
 
-def unit_conversion(x):
-    val = x['value']
-    raw_conv_r = float(x.raw_conv_ratio) if x.raw_conv_ratio and not np.isnan(x.raw_conv_ratio) else 1
-    harm_conv_r = float(x.harm_conv_ratio) if x.harm_conv_ratio and not np.isnan(x.harm_conv_ratio) else 1
-    raw_conv_o = float(x.raw_conv_offset) if x.raw_conv_offset and not np.isnan(x.raw_conv_offset) else 0
-    harm_conv_o = float(x.harm_conv_offset) if x.harm_conv_offset and not np.isnan(x.harm_conv_offset) else 0
-    return val * float(raw_conv_r) / float(harm_conv_r) + (float(raw_conv_o) - float(harm_conv_o))
+def unit_conversion(values, dev, raw_ratio=None):
+    """
+    Converts the raw `values` (a Series) of the device to its harmonized unit
+    """
+    scale, offset = conversion_affine(dev, raw_ratio)
+    return values * scale + offset
 
 
 def send_to_kafka(producer, kafka_topic, df_to_send):
@@ -62,9 +253,7 @@ def send_to_kafka(producer, kafka_topic, df_to_send):
 
 
 def complete_missing_points(df, ts_ini, ts_end, freq):
-    ts_ini = pd.Timestamp(ts_ini).floor(pd.Timedelta(freq))
-    ts_end = pd.Timestamp(ts_end).floor(pd.Timedelta(freq))
-    full_time_index = pd.date_range(start=ts_ini, end=ts_end, freq=pd.Timedelta(freq))
+    full_time_index = bucket_index(ts_ini, ts_end, freq)
     complete = df.reindex(full_time_index, fill_value=None)
     complete['value'] = complete.value.astype(object)
     complete[pd.isna(complete['value'])] = None
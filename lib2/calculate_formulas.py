@@ -1,38 +1,44 @@
 import base64
 import datetime
 import isodate
-import neo4j
 import numpy as np
 import pandas as pd
 import beelib
 import xml.etree.ElementTree as ElementTree
 
+from lib2.connections import run_query
+from lib2.time_buckets import bucket_index, comparable_freq, isodate_floor, transform_freq
 
-def isodate_floor(timestamp, freq):
-    if freq == "P1M":
-        return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    elif freq == "P1W":
-        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0) - pd.DateOffset(days=timestamp.weekday())
-    else:
-        return timestamp.floor(pd.Timedelta(freq))
 
+DEVICES_MEASUREMENTS_QUERY = """
+    MATCH (n:saref__Device)-[:saref__makesMeasurement]->(m)-[:saref__relatesToProperty]->(p:saref__Property)
+    WHERE n.uri in $uris
+    RETURN n.uri as uri, collect({hash: m.bigg__hash , freq: m.bigg__measurementFrequency, func: p.bigg__aggregationFunction}) as mes
+    UNION MATCH(n:s4city__KeyPerformanceIndicatorAssessment)-[:s4city__quantifiesKPI]->(q:s4city__KeyPerformanceIndicator)
+    WHERE n.uri in $uris
+    RETURN n.uri as uri, collect({hash: n.bigg__hash , freq: n.bigg__measurementFrequency, func: q.bigg__aggregationFunction}) as mes
+"""
 
-def comparable_freq(freq):
-    if freq == "P1M":
-        return pd.Timedelta(days=30)
-    else:
-        return pd.Timedelta(freq)
 
-
-def transform_freq(freq):
-    if freq == "P1M":
-        return f"1MS"
-    else:
-        return pd.Timedelta(freq)
+def formula_uris(formula):
+    """
+    Returns the uris of the devices referenced by the `mh` elements of the formula, at any depth. Formulas that
+    can't be parsed have no uris, they fail when calculated.
+    """
+    try:
+        formula_tree = ElementTree.fromstring(f"<root>{formula}</root>")
+    except ElementTree.ParseError:
+        return []
+    return [base64.b64decode(x.text.encode()).decode() for x in formula_tree.iter("mh")]
 
 
 class CalculateFunctions(object):
-    def __init__(self, druid_connection, druid_datasource, influx_connection, neo4j_connection, source):
+    def __init__(self, druid_connection, druid_datasource, influx_connection, neo4j_connection, source,
+                 measurements=None):
+        """
+        `measurements` is the index of the measurements (hash, freq and func) of each device uri, it is shared by the
+        calculators of a process so each uri is only queried once.
+        """
         self.druid_connection = druid_connection
         self.druid_datasource = druid_datasource
         self.influx_connection = influx_connection
@@ -46,6 +52,7 @@ class CalculateFunctions(object):
             "LAST": "last"
         }
         self.source = source
+        self.measurements = measurements if measurements is not None else {}
 
         self.AVAILABLE_FUNCTIONS = {
             "CLIP": self.__clip__,
@@ -53,24 +60,21 @@ class CalculateFunctions(object):
             "HE": self.__he__
         }
 
+    def resolve_measurements(self, uris):
+        """
+        Adds the measurements of the uris missing in the index with a single query and returns the index
+        """
+        missing = list(dict.fromkeys(u for u in uris if u not in self.measurements))
+        if missing:
+            resolved = {u: [] for u in missing}
+            for x in run_query(self.neo4j_connection, DEVICES_MEASUREMENTS_QUERY, uris=missing):
+                resolved[x['uri']].extend(x['mes'])
+            self.measurements.update(resolved)
+        return self.measurements
+
     def _get_device_measurements_(self, devices):
-        dev_info = []
-        for device in devices:
-            d_formula = device['m']['bee__calculationFormula']
-            d_formula = f"<root>{d_formula}</root>"
-            formula_tree = ElementTree.fromstring(d_formula)
-            dev_info.extend(formula_tree.findall("./mh"))
-        devices_uris = [base64.b64decode(x.text.encode()).decode() for x in dev_info]
-        driver = neo4j.GraphDatabase.driver(**self.neo4j_connection)
-        measurement_list = driver.session().run(f"""
-            MATCH (n:saref__Device)-[:saref__makesMeasurement]->(m)-[:saref__relatesToProperty]->(p:saref__Property)
-            WHERE n.uri in {devices_uris}
-            RETURN n.uri as uri, collect({{hash: m.bigg__hash , freq: m.bigg__measurementFrequency, func: p.bigg__aggregationFunction}}) as mes
-            UNION MATCH(n:s4city__KeyPerformanceIndicatorAssessment)-[:s4city__quantifiesKPI]->(q:s4city__KeyPerformanceIndicator)
-            WHERE n.uri in {devices_uris}
-            RETURN n.uri as uri, collect({{hash: n.bigg__hash , freq: n.bigg__measurementFrequency, func: q.bigg__aggregationFunction}}) as mes
-            """).data()
-        return {x['uri']: x['mes'] for x in measurement_list}
+        return self.resolve_measurements([u for device in devices
+                                          for u in formula_uris(device['m']['bee__calculationFormula'])])
 
     def _get_prio_(self, device, devices, dev_info):
         if 'prio' in device:
@@ -147,19 +151,10 @@ class CalculateFunctions(object):
 
     def __get_timeseries__(self, bigg_hash, source, ts_ini, ts_end, freq):
         device_uri = base64.b64decode(bigg_hash.encode()).decode()
-        driver = neo4j.GraphDatabase.driver(**self.neo4j_connection)
-        hash_list = driver.session().run(f"""
-            MATCH (n:saref__Device)-[:saref__makesMeasurement]->(m)-[:saref__relatesToProperty]->(p:saref__Property)
-            WHERE n.uri="{device_uri}" 
-            RETURN m.bigg__hash as hash, m.bigg__measurementFrequency as freq, p.bigg__aggregationFunction as func
-            UNION MATCH(n:s4city__KeyPerformanceIndicatorAssessment)-[:s4city__quantifiesKPI]->(q:s4city__KeyPerformanceIndicator)
-            WHERE n.uri="{device_uri}" 
-            RETURN n.bigg__hash as hash, n.bigg__measurementFrequency as freq, q.bigg__aggregationFunction as func
-            """).data()
+        hash_list = self.resolve_measurements([device_uri])[device_uri]
         ts_ini = isodate_floor(pd.Timestamp(ts_ini), freq)
         ts_end = isodate_floor(pd.Timestamp(ts_end), freq)
-        device_df = pd.DataFrame(index=pd.date_range(start=ts_ini, end=ts_end,
-                                                     freq=transform_freq(freq)))
+        device_df = pd.DataFrame(index=bucket_index(ts_ini, ts_end, freq))
         for h in sorted(hash_list,
                         key=lambda x: abs(comparable_freq(x['freq']) - comparable_freq(freq)),
                         reverse=False):
@@ -195,15 +190,11 @@ class CalculateFunctions(object):
         return device_df
 
     def __create_constant_timeseries__(self, value, ts_ini, ts_end, freq):
-        ts_ini = isodate_floor(pd.Timestamp(ts_ini), freq)
-        ts_end = isodate_floor(pd.Timestamp(ts_end), freq)
-        r = pd.date_range(ts_ini, ts_end, freq=transform_freq(freq))
-        return pd.DataFrame({"value": value}, index=r).astype(float)
+        return pd.DataFrame({"value": value}, index=bucket_index(ts_ini, ts_end, freq)).astype(float)
 
     def __create_query_timeseries__(self, encoded_query, ts_ini, ts_end, freq):
-        driver = neo4j.GraphDatabase.driver(**self.neo4j_connection)
         query = base64.b64decode(encoded_query.encode()).decode('utf-8')
-        value = list(driver.session().run(query).data()[0].values())[0]
+        value = list(run_query(self.neo4j_connection, query)[0].values())[0]
         return self.__create_constant_timeseries__(value, ts_ini, ts_end, freq)
 
     def __apply_function__(self, formula_tree, ts_ini, ts_end, freq, level, custom_df):
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import warnings
+from contextlib import contextmanager
+
+import happybase
+import neo4j
+import redis
+
+# clients of this process by (kind, configuration), they are not shared with forked processes
+_clients = {}
+_clients_pid = os.getpid()
+_lock = threading.Lock()
+# runs of each query template by this process, the queries are constant templates with $parameters so neo4j can
+# reuse the plan of each of them
+_query_stats = {}
+# connections of the hbase pools, unless the configuration gives its own "pool_size"
+HBASE_POOL_SIZE = 4
+
+
+def _close_neo4j_(driver):
+    driver.close()
+
+
+def _check_neo4j_(driver):
+    driver.verify_connectivity()
+
+
+def _create_hbase_pool_(hbase_connection):
+    # the pool must have a connection for each device read at the same time by a worker
+    hbase_connection = dict(hbase_connection)
+    size = hbase_connection.pop("pool_size", HBASE_POOL_SIZE)
+    return happybase.ConnectionPool(size, **hbase_connection)
+
+
+def _close_hbase_(pool):
+    # happybase pools have no close. With happybase 1.2.0 (requirements.txt) the idle connections are in the private
+    # queue of the pool and are closed one by one, a version without it is warned instead of leaking them silently
+    idle = getattr(pool, "_queue", None)
+    if idle is None:
+        warnings.warn("happybase ConnectionPool has no _queue, its connections are not closed")
+        return
+    while True:
+        try:
+            connection = idle.get_nowait()
+        except queue.Empty:
+            return
+        connection.close()
+
+
+def _check_hbase_(pool):
+    with pool.connection() as connection:
+        connection.tables()
+
+
+CLIENT_TYPES = {
+    "neo4j": {"create": lambda conf: neo4j.GraphDatabase.driver(**conf), "close": _close_neo4j_,
+              "check": _check_neo4j_},
+    "redis": {"create": lambda conf: redis.Redis(**conf), "close": lambda c: c.close(), "check": lambda c: c.ping()},
+    "hbase": {"create": _create_hbase_pool_, "close": _close_hbase_, "check": _check_hbase_},
+}
+
+
+def _key_(kind, config):
+    return kind, json.dumps(config, sort_keys=True, default=str)
+
+
+def get_client(kind, config):
+    """
+    Returns the client of the process for the configuration, creating it the first time. Clients are thread safe
+    and keep their own connection pool, so they are shared by all the code of the process.
+    """
+    global _clients, _clients_pid
+    key = _key_(kind, config)
+    with _lock:
+        if _clients_pid != os.getpid():
+            # the clients of the parent can't be used after a fork
+            _clients, _clients_pid = {}, os.getpid()
+        if key not in _clients:
+            _clients[key] = CLIENT_TYPES[kind]['create'](config)
+        return _clients[key]
+
+
+def get_neo4j(neo4j_connection):
+    return get_client("neo4j", neo4j_connection)
+
+
+def get_redis(redis_connection):
+    return get_client("redis", redis_connection)
+
+
+def get_hbase_pool(hbase_connection):
+    return get_client("hbase", hbase_connection)
+
+
+@contextmanager
+def neo4j_session(neo4j_connection):
+    with get_neo4j(neo4j_connection).session() as session:
+        yield session
+
+
+def run_query(neo4j_connection, query, **params):
+    """
+    Runs the query with its `params` in a session of the shared driver and returns its data, closing the session.
+    The query must be a constant template, values are only given as parameters.
+    """
+    with neo4j_session(neo4j_connection) as session:
+        result = session.run(query, params)
+        data = result.data()
+        summary = result.consume()
+    _track_query_(query, summary.result_available_after)
+    return data
+
+
+def _track_query_(query, available_after):
+    key = hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+    with _lock:
+        stats = _query_stats.setdefault(key, {"query": " ".join(query.split())[:80], "runs": 0,
+                                              "first_ms": available_after, "repeat_ms": 0})
+        stats['runs'] += 1
+        if stats['runs'] > 1 and available_after is not None:
+            stats['repeat_ms'] += available_after
+
+
+def query_stats():
+    """
+    Returns the runs of each query template, the ms neo4j took to start returning the first run and the average ms
+    of the repeated runs. Whether a run reused a cached plan is not measured.
+    """
+    with _lock:
+        return {k: {"query": v['query'], "runs": v['runs'], "repeat_runs": v['runs'] - 1,
+                    "first_ms": v['first_ms'],
+                    "repeat_avg_ms": v['repeat_ms'] / (v['runs'] - 1) if v['runs'] > 1 else None}
+                for k, v in _query_stats.items()}
+
+
+def check_connections():
+    """
+    Checks every client of the process, returns a dict with the errors of the failing clients by kind
+    """
+    errors = {}
+    for (kind, _), client in list(_clients.items()):
+        try:
+            CLIENT_TYPES[kind]['check'](client)
+        except Exception as e:
+            errors.setdefault(kind, []).append(str(e))
+    return errors
+
+
+def close_all():
+    """
+    Closes every client of the process, the next use creates them again
+    """
+    global _clients
+    with _lock:
+        clients, _clients = _clients, {}
+    for (kind, _), client in clients.items():
+        try:
+            CLIENT_TYPES[kind]['close'](client)
+        except Exception:
+            pass
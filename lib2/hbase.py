@@ -0,0 +1,141 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from lib2.connections import get_hbase_pool
+
+# seconds the list of tables of a server is reused before listing them again
+TABLES_TTL = 600
+# rows of each batch yielded by scan_batches
+SCAN_BATCH_SIZE = 100000
+
+# scans kept by the process once read, for the next devices reading the same rows, and the bytes they can take
+SHARED_SCANS = 4
+SHARED_SCANS_BYTES = 64 * 1024 * 1024
+
+# tables of each server by its configuration, with the time they expire
+_tables = {}
+_tables_lock = threading.Lock()
+# futures of the scans being read or recently read by the process, by their key
+_scans = OrderedDict()
+_scans_lock = threading.Lock()
+# bytes of the scans already read and kept
+_scan_bytes = {}
+_scans_max_bytes = SHARED_SCANS_BYTES
+
+
+def get_tables(hbase_connection, pattern, ttl=TABLES_TTL):
+    """
+    Returns the tables of the server matching the regex `pattern`. The tables of a server are listed once every
+    `ttl` seconds and shared by all the sources and devices read from it.
+    """
+    key = json.dumps(hbase_connection, sort_keys=True, default=str)
+    with _tables_lock:
+        expires, tables = _tables.get(key, (0, []))
+        if expires < time.time():
+            with get_hbase_pool(hbase_connection).connection() as connection:
+                tables = [t.decode("utf-8") for t in connection.tables()]
+            _tables[key] = (time.time() + ttl, tables)
+    return [t for t in tables if re.match(pattern, t)]
+
+
+def clear_tables():
+    """
+    Forgets the tables listed, so the next read lists them again (e.g. after creating tables)
+    """
+    with _tables_lock:
+        _tables.clear()
+
+
+def scan_projection(columns):
+    """
+    Returns the scan arguments to only read the `columns` of the rows. Columns given as "<family>:<qualifier>" are
+    requested by name, bare qualifiers are selected with a server side filter as their family is not known. Rows
+    without any of the columns are not returned.
+    """
+    if not columns:
+        return {}
+    if all(":" in c for c in columns):
+        return {"columns": list(columns)}
+    qualifiers = "|".join(re.escape(c.split(":")[-1]) for c in columns)
+    return {"filter": f"QualifierFilter(=, 'regexstring:^({qualifiers})$')"}
+
+
+def scan_batches(hbase_connection, table, row_start=None, row_stop=None, batch_size=SCAN_BATCH_SIZE, columns=None):
+    """
+    Yields the (key, row) pairs of the table between `row_start` and `row_stop` in lists of `batch_size` rows,
+    scanning with a connection of the pool of the server. With `columns`, only those columns are read.
+    """
+    with get_hbase_pool(hbase_connection).connection() as connection:
+        batch = []
+        for row in connection.table(table).scan(row_start=row_start, row_stop=row_stop, batch_size=batch_size,
+                                                **scan_projection(columns)):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def configure_shared_scans(max_bytes=SHARED_SCANS_BYTES):
+    """
+    Sets the bytes of the scans kept by the process for the next devices, part of the in-flight budget of the worker
+    """
+    global _scans_max_bytes
+    with _scans_lock:
+        _scans_max_bytes = max_bytes
+        _evict_scans_()
+
+
+def _data_bytes_(data):
+    try:
+        return int(data.memory_usage(deep=True).sum())
+    except AttributeError:
+        return 0
+
+
+def _evict_scans_():
+    # the oldest scans read are dropped while over the limits, the ones being read stay for their waiters
+    total = sum(_scan_bytes.values())
+    for key in list(_scans):
+        if len(_scans) <= SHARED_SCANS and total <= _scans_max_bytes:
+            break
+        if key in _scan_bytes:
+            total -= _scan_bytes.pop(key)
+            del _scans[key]
+
+
+def shared_scan(key, read):
+    """
+    Returns the result of `read()` for the scan `key`, read once for all the devices of the process reading the
+    same rows: a device asking for a scan being read by another thread waits for its result, and the last
+    SHARED_SCANS scans read are kept for the devices coming next, within the bytes set by configure_shared_scans.
+    The result is shared, it must not be modified.
+    """
+    with _scans_lock:
+        future = _scans.get(key)
+        owner = future is None
+        if owner:
+            future = _scans[key] = Future()
+        else:
+            _scans.move_to_end(key)
+    if owner:
+        try:
+            result = read()
+        except Exception as e:
+            future.set_exception(e)
+            with _scans_lock:
+                if _scans.get(key) is future:
+                    del _scans[key]
+        else:
+            future.set_result(result)
+            size = _data_bytes_(result)
+            with _scans_lock:
+                if _scans.get(key) is future:
+                    _scan_bytes[key] = size
+                    _evict_scans_()
+    return future.result()
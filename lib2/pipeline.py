@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from lib2 import send_to_kafka
+
+
+def data_bytes(data):
+    try:
+        usage = data.memory_usage(deep=True)
+    except AttributeError:
+        return 0
+    return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+
+
+def prefetch(items, fetch, depth, max_bytes):
+    """
+    Yields each item with the future of `fetch(item)`, fetching up to `depth` items ahead in background threads
+    while the caller processes the current one. No new fetch is started while the data already fetched and not
+    consumed is over `max_bytes`. The data of each fetch is measured once, when it completes.
+    """
+    items = iter(items)
+    pending = deque()
+    exhausted = False
+    lock = threading.Lock()
+    # size of the fetches completed and not consumed, and the fetches consumed before completing
+    sizes = {}
+    consumed = set()
+    ready_bytes = 0
+
+    def measure(future):
+        nonlocal ready_bytes
+        size = data_bytes(future.result()) if future.exception() is None else 0
+        with lock:
+            if future in consumed:
+                consumed.discard(future)
+            else:
+                sizes[future] = size
+                ready_bytes += size
+
+    with ThreadPoolExecutor(max(1, depth)) as executor:
+        while True:
+            while not exhausted and len(pending) < max(1, depth) and (not pending or ready_bytes < max_bytes):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(fetch, item)
+                future.add_done_callback(measure)
+                pending.append((item, future))
+            if not pending:
+                return
+            item, future = pending.popleft()
+            with lock:
+                if future in sizes:
+                    ready_bytes -= sizes.pop(future)
+                else:
+                    consumed.add(future)
+            yield item, future
+
+
+class BackgroundSender(object):
+    """
+    Sends the data to kafka from a background thread. `send` only blocks when the data waiting to be sent is
+    over `max_bytes`, and `join` waits until everything is sent and returns the errors found. `submitted` and
+    `completed` count the messages sent to the thread and the ones it has finished. `on_sent` is called from
+    the thread once the data has been sent without errors.
+    """
+    def __init__(self, producer, max_bytes):
+        self.producer = producer
+        self.max_bytes = max_bytes
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.sending = False
+        self.submitted = 0
+        self.completed = 0
+        self.errors = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run_, daemon=True)
+        self.thread.start()
+
+    def send(self, kafka_topic, df_to_send, on_sent=None):
+        size = data_bytes(df_to_send)
+        with self.condition:
+            while self.pending and self.pending_bytes + size > self.max_bytes:
+                self.condition.wait()
+            self.pending.append((kafka_topic, df_to_send, size, on_sent))
+            self.pending_bytes += size
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.pending or self.sending:
+                self.condition.wait()
+            errors, self.errors = self.errors, []
+        return errors
+
+    def _run_(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                kafka_topic, df_to_send, size, on_sent = self.pending.popleft()
+                self.sending = True
+            try:
+                send_to_kafka(self.producer, kafka_topic, df_to_send)
+                if on_sent:
+                    on_sent()
+            except Exception as e:
+                self.errors.append(e)
+            with self.condition:
+                self.pending_bytes -= size
+                self.completed += 1
+                self.sending = False
+                self.condition.notify_all()
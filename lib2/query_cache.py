@@ -0,0 +1,83 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+# seconds the results of a query are reused before querying neo4j again
+QUERY_CACHE_TTL = 3600
+
+
+def create_query_cache(redis_conn=None, path=None, ttl=QUERY_CACHE_TTL, prefix="harmonizer.query_cache"):
+    """
+    Cache of the results of the device queries, stored in redis or, without `redis_conn`, as json files in `path`.
+    A cache with `ttl` 0 never stores anything.
+    """
+    return {"redis": redis_conn, "path": path, "ttl": ttl, "prefix": prefix}
+
+
+def query_cache_key(cache, source_name, query, params):
+    """
+    Key of the result of the query with its `params`. The query is normalized, so it only changes with its meaning,
+    not with its whitespace. The rest of the run (e.g. its `diff`, that only names the redis keys of the run) does
+    not change the devices returned, so it is not part of the key.
+    """
+    normalized = " ".join(query.split())
+    query_hash = hashlib.sha1(json.dumps({"query": normalized, "params": params}, sort_keys=True,
+                                         default=str).encode("utf-8")).hexdigest()
+    return f"{cache['prefix']}.{source_name.lower()}.{query_hash}"
+
+
+def _read_(cache, key):
+    if cache['redis'] is not None:
+        data = cache['redis'].get(key)
+        return json.loads(data) if data is not None else None
+    try:
+        with open(os.path.join(cache['path'], f"{key}.json")) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data['result'] if data['expires'] > time.time() else None
+
+
+def _write_(cache, key, result):
+    if cache['redis'] is not None:
+        cache['redis'].set(key, json.dumps(result, default=str), ex=cache['ttl'])
+        return
+    os.makedirs(cache['path'], exist_ok=True)
+    tmp = os.path.join(cache['path'], f"{key}.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"expires": time.time() + cache['ttl'], "result": result}, f, default=str)
+    os.replace(tmp, os.path.join(cache['path'], f"{key}.json"))
+
+
+def cached_query(cache, source_name, query, params, load):
+    """
+    Returns the cached result of the query of the source with its `params`, calling `load()` and caching its result
+    when missing or expired. A None result is a failed query and is not cached.
+    """
+    if not cache or not cache['ttl']:
+        return load()
+    key = query_cache_key(cache, source_name, query, params)
+    result = _read_(cache, key)
+    if result is None:
+        result = load()
+        if result is not None:
+            _write_(cache, key, result)
+    return result
+
+
+def invalidate_queries(cache, source_name=None):
+    """
+    Removes the cached results of the queries of the source, or of all of them, so they are read again from neo4j
+    """
+    prefix = f"{cache['prefix']}.{source_name.lower()}." if source_name else f"{cache['prefix']}."
+    if cache['redis'] is not None:
+        keys = list(cache['redis'].scan_iter(match=f"{prefix}*"))
+        if keys:
+            cache['redis'].delete(*keys)
+        return len(keys)
+    files = glob.glob(os.path.join(glob.escape(cache['path']), f"{glob.escape(prefix)}*.json"))
+    for f in files:
+        os.remove(f)
+    return len(files)
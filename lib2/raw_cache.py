@@ -0,0 +1,142 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+DAY = 86400
+# days, counting today, whose raw rows can still change and are never cached
+OPEN_DAYS = 2
+# bytes of the cache on disk, the least recently read partitions are removed over it
+RAW_CACHE_BYTES = 20 * 1024 ** 3
+# columns of the rows coming from their key and table, the rest are the values read
+KEY_COLUMNS = ["uri", "ts", "freq"]
+
+# cache of the process, disabled until configured
+_cache = None
+_lock = threading.Lock()
+
+
+def configure_raw_cache(path, max_bytes=RAW_CACHE_BYTES, open_days=OPEN_DAYS):
+    """
+    Enables the cache of the raw rows read from hbase for the process, stored in `path` as an arrow file for each
+    scan and day. A None `path` disables it.
+    """
+    global _cache
+    _cache = {"path": path, "max_bytes": max_bytes, "open_days": open_days, "total": None} if path else None
+    return _cache
+
+
+def get_raw_cache():
+    return _cache
+
+
+def _partition_path_(cache, key, day):
+    key_hash = hashlib.sha1(json.dumps(key, default=str).encode("utf-8")).hexdigest()
+    return os.path.join(cache['path'], key_hash[:2], key_hash, f"{day}.arrow")
+
+
+def _is_closed_(cache, day):
+    today = int(time.time()) // DAY * DAY
+    return day < today - (cache['open_days'] - 1) * DAY
+
+
+def _read_partition_(path):
+    try:
+        rows = feather.read_table(path, memory_map=True).to_pandas()
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    # values missing in a row are NaN as when read from hbase, arrow gives them as None
+    for c in rows.columns.difference(KEY_COLUMNS):
+        rows[c] = rows[c].astype(object).where(rows[c].notna(), np.nan)
+    return rows
+
+
+def _write_partition_(cache, path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    feather.write_feather(rows.reset_index(drop=True), tmp, compression="uncompressed")
+    os.replace(tmp, path)
+    with _lock:
+        if cache['total'] is None:
+            cache['total'] = _cache_bytes_(cache)
+        else:
+            cache['total'] += os.path.getsize(path)
+        if cache['total'] > cache['max_bytes']:
+            cache['total'] = _evict_(cache)
+
+
+def _partitions_(cache):
+    for path in glob.glob(os.path.join(glob.escape(cache['path']), "*", "*", "*.arrow")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        yield stat.st_mtime, stat.st_size, path
+
+
+def _cache_bytes_(cache):
+    return sum(size for _, size, _ in _partitions_(cache))
+
+
+def _evict_(cache):
+    """
+    Removes the least recently read partitions until the cache is 90% of its size, returns the bytes left
+    """
+    partitions = sorted(_partitions_(cache))
+    total = sum(size for _, size, _ in partitions)
+    for _, size, path in partitions:
+        if total <= cache['max_bytes'] * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def _missing_ranges_(days):
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + DAY
+        else:
+            ranges.append([day, day + DAY])
+    return ranges
+
+
+def cached_rows(cache, key, ts_ini, ts_end, read):
+    """
+    Returns the rows of the scan `key` with their ts in [ts_ini, ts_end). The closed days already cached are read
+    from disk, the rest are read with `read(start, end)` in ranges of whole days, and the closed days read are
+    stored for the next time.
+    """
+    parts = []
+    missing = []
+    for day in range(ts_ini // DAY * DAY, ts_end, DAY):
+        rows = None
+        if _is_closed_(cache, day):
+            rows = _read_partition_(_partition_path_(cache, key, day))
+        if rows is None:
+            missing.append(day)
+        else:
+            parts.append((day, rows))
+    for start, end in _missing_ranges_(missing):
+        rows = read(start, end)
+        for day in range(start, end, DAY):
+            day_rows = rows[(rows['ts'] >= day) & (rows['ts'] < day + DAY)] if not rows.empty else rows
+            if _is_closed_(cache, day):
+                _write_partition_(cache, _partition_path_(cache, key, day), day_rows)
+            parts.append((day, day_rows))
+    parts = [rows for _, rows in sorted(parts, key=lambda x: x[0]) if not rows.empty]
+    if not parts:
+        return pd.DataFrame()
+    rows = pd.concat(parts, ignore_index=True)
+    return rows[(rows['ts'] >= ts_ini) & (rows['ts'] < ts_end)].reset_index(drop=True)
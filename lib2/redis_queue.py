@@ -0,0 +1,184 @@
+import json
+import threading
+
+# max number of devices claimed in a single round trip
+MAX_CLAIM = 50
+# a worker claims at most 1/CLAIM_SHARE of its fair share of the queue at once, so the tail stays balanced
+CLAIM_SHARE = 4
+
+# catalogs already downloaded by this process, by redis base
+_catalogs = {}
+
+CLAIM_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('LREM', KEYS[2], 1, ARGV[i])
+end
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local item = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not item then
+        break
+    end
+    items[#items + 1] = item
+end
+return {redis.call('LLEN', KEYS[1]), items}
+"""
+
+TAKE_OVER_SCRIPT = """
+local items = {}
+while true do
+    local item = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not item then
+        break
+    end
+    items[#items + 1] = item
+end
+return items
+"""
+
+
+def claim_size(queue_len, workers):
+    if queue_len is None:
+        return 1
+    return max(1, min(MAX_CLAIM, queue_len // (max(1, workers) * CLAIM_SHARE)))
+
+
+def processing_key(redis_base, worker_id):
+    return f"{redis_base}.processing.{worker_id}"
+
+
+def claim_batch(redis_conn, queue, processing, size, acked=()):
+    """
+    Atomically moves up to `size` items from the queue to the processing list of the worker, after removing from
+    it the `acked` items already processed. Returns the items and the length of the queue left.
+    """
+    queue_len, items = redis_conn.eval(CLAIM_SCRIPT, 2, queue, processing, size, *acked)
+    return items, int(queue_len)
+
+
+def ack_devices(redis_conn, processing, acked):
+    pipe = redis_conn.pipeline()
+    for item in acked:
+        pipe.lrem(processing, 1, item)
+    pipe.execute()
+
+
+def take_over(redis_conn, redis_base, dead_id, worker_id):
+    """
+    Moves the items leased by a lost worker to the processing list of this worker and returns them.
+    """
+    return redis_conn.eval(TAKE_OVER_SCRIPT, 2, processing_key(redis_base, dead_id),
+                           processing_key(redis_base, worker_id))
+
+
+def publish_devices(redis_conn, redis_base, devices, version):
+    """
+    Stores the devices once as a versioned catalog and fills the queue with their positions in it. The processing
+    lists left by the workers of a previous run that died are removed, they would be taken over by this run.
+    """
+    stale = list(redis_conn.scan_iter(match=processing_key(redis_base, "*")))
+    pipe = redis_conn.pipeline()
+    if stale:
+        pipe.delete(*stale)
+    pipe.set(f"{redis_base}.catalog", json.dumps({"version": version, "devices": devices}))
+    pipe.set(f"{redis_base}.catalog.version", version)
+    pipe.delete(f"{redis_base}.queue")
+    if devices:
+        pipe.lpush(f"{redis_base}.queue", *range(len(devices)))
+    pipe.execute()
+
+
+def load_catalog(redis_conn, redis_base):
+    """
+    Returns the devices of the catalog, downloading it only when the published version is not the cached one.
+    """
+    version = redis_conn.get(f"{redis_base}.catalog.version")
+    if redis_base not in _catalogs or version is None or _catalogs[redis_base]['version'] != int(version):
+        catalog = redis_conn.get(f"{redis_base}.catalog")
+        _catalogs[redis_base] = json.loads(catalog) if catalog else {"version": None, "devices": []}
+    return _catalogs[redis_base]['devices']
+
+
+def claim_devices(redis_conn, redis_base, workers, worker_id, done):
+    """
+    Yields the devices of the queue with the number of devices still queued and their item in the queue,
+    claiming them in batches sized from the queue length returned by the previous claim. Claimed devices stay
+    leased in the processing list of the worker until their items are added to `done`, that is acknowledged
+    with the next claim.
+    """
+    catalog = None
+    queue_len = None
+    while queue_len != 0:
+        items, queue_len = claim_batch(redis_conn, f"{redis_base}.queue", processing_key(redis_base, worker_id),
+                                       claim_size(queue_len, workers), done)
+        del done[:]
+        if not items:
+            break
+        if catalog is None:
+            catalog = load_catalog(redis_conn, redis_base)
+        for i, item in enumerate(items):
+            yield catalog[int(item)], queue_len + len(items) - i - 1, item
+
+
+def start_lease(redis_conn, lease_key, ttl):
+    """
+    Keeps the lease key alive from a background thread until the returned event is set.
+    """
+    stop = threading.Event()
+    redis_conn.set(lease_key, 1, ex=ttl)
+
+    def heartbeat():
+        while not stop.wait(ttl / 3):
+            try:
+                redis_conn.set(lease_key, 1, ex=ttl)
+            except Exception:
+                pass
+        redis_conn.delete(lease_key)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stop
+
+
+# weight of the last observation in the exponential moving average of the device costs
+COST_DECAY = 0.3
+# seconds the cost history is kept without being updated
+COST_TTL = 3600 * 24 * 7
+
+REPORT_COST_SCRIPT = """
+local decay = tonumber(ARGV[1])
+for i = 3, #ARGV, 3 do
+    local seconds = tonumber(ARGV[i + 1])
+    local rows = tonumber(ARGV[i + 2])
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        local old_seconds, old_rows = string.match(old, '([^,]+),([^,]+)')
+        seconds = tonumber(old_seconds) * (1 - decay) + seconds * decay
+        rows = tonumber(old_rows) * (1 - decay) + rows * decay
+    end
+    redis.call('HSET', KEYS[1], ARGV[i], string.format('%.3f,%.1f', seconds, rows))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return #ARGV
+"""
+
+
+def report_costs(redis_conn, cost_key, costs):
+    """
+    Updates the cost history with a list of (device_key, seconds, rows) tuples.
+    """
+    args = [COST_DECAY, COST_TTL]
+    for device_key, seconds, rows in costs:
+        args.extend([device_key, seconds, rows])
+    redis_conn.eval(REPORT_COST_SCRIPT, 1, cost_key, *args)
+
+
+def order_by_cost(redis_conn, cost_key, devices, device_key):
+    """
+    Sorts the devices so the most expensive ones are claimed first once pushed with lpush. Devices without
+    history are considered the most expensive, as they are new or were too slow to report.
+    """
+    if not devices:
+        return devices
+    costs = redis_conn.hmget(cost_key, [device_key(d) for d in devices])
+    costs = [float(c.split(b",")[0]) if c else float("inf") for c in costs]
+    return [d for _, d in sorted(zip(costs, devices), key=lambda x: x[0], reverse=True)]
@@ -0,0 +1,140 @@
+import time
+import uuid
+
+# seconds a waiting worker blocks on redis before checking its own timeout again
+BARRIER_BLOCK = 5
+# seconds the release tokens are kept once a barrier has been completed
+RELEASE_TTL = 3600
+
+ARRIVE_SCRIPT = """
+local left = tonumber(redis.call('GET', KEYS[1]) or '0')
+if left <= 0 then
+    return -1
+end
+if redis.call('SADD', KEYS[3], ARGV[4]) == 0 then
+    return left
+end
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+left = redis.call('DECRBY', KEYS[1], ARGV[1])
+if left <= 0 then
+    redis.call('DEL', KEYS[2])
+    for i = 1, tonumber(ARGV[2]) do
+        redis.call('RPUSH', KEYS[2], i)
+    end
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+return left
+"""
+
+
+def barrier_keys(redis_base):
+    return {"semaphore": f"{redis_base}.semaphore", "gate": f"{redis_base}.gate",
+            "release": f"{redis_base}.release", "arrived": f"{redis_base}.arrived"}
+
+
+def reset_barrier(redis_conn, redis_base, parties):
+    """
+    Sets the barrier to wait for `parties` workers. A barrier reset with 0 parties stays closed until
+    `open_barrier` is called (used by the start barrier and by the stages whose devices are published while
+    the workers run, opened by the starter)
+    """
+    keys = barrier_keys(redis_base)
+    redis_conn.delete(keys['gate'], keys['release'], keys['arrived'])
+    redis_conn.set(keys['semaphore'], parties)
+
+
+def open_barrier(redis_conn, redis_base, parties):
+    keys = barrier_keys(redis_base)
+    pipe = redis_conn.pipeline()
+    pipe.delete(keys['release'], keys['arrived'])
+    pipe.set(keys['semaphore'], parties)
+    pipe.delete(keys['gate'])
+    pipe.rpush(keys['gate'], *range(parties))
+    pipe.expire(keys['gate'], RELEASE_TTL)
+    pipe.execute()
+
+
+def delete_barrier(redis_conn, redis_base):
+    redis_conn.delete(*barrier_keys(redis_base).values())
+
+
+def _block_until_(redis_conn, key, deadline, on_idle=None):
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("The process starting was too slow")
+        if redis_conn.blpop([key], timeout=max(1, int(min(remaining, BARRIER_BLOCK)))):
+            return
+        if on_idle:
+            on_idle()
+
+
+def arrive(redis_conn, redis_base, parties, participant, weight=1):
+    """
+    Registers the `weight` workers of `participant` at the barrier, a participant only counts once. The last
+    worker arriving pushes one release token per party so the waiting workers are woken up by redis instead of
+    polling. Returns the number of workers still missing, or -1 if the barrier is not open yet.
+    """
+    keys = barrier_keys(redis_base)
+    return int(redis_conn.eval(ARRIVE_SCRIPT, 3, keys['semaphore'], keys['release'], keys['arrived'], weight,
+                               parties, RELEASE_TTL, participant))
+
+
+def barrier_wait(redis_conn, redis_base, parties, time_min, weight=1, participant=None):
+    """
+    Blocks until all the `parties` workers have arrived at the barrier. Returns a dict with the ticket obtained
+    and the seconds spent waiting for the gate to open and for the rest of workers.
+    """
+    keys = barrier_keys(redis_base)
+    participant = participant if participant else uuid.uuid4().hex
+    start = time.time()
+    deadline = start + 60 * time_min
+    left = arrive(redis_conn, redis_base, parties, participant, weight)
+    while left < 0:
+        _block_until_(redis_conn, keys['gate'], deadline)
+        left = arrive(redis_conn, redis_base, parties, participant, weight)
+    arrived = time.time()
+    if left > 0:
+        _block_until_(redis_conn, keys['release'], deadline)
+    end = time.time()
+    return {"ticket": left, "gate_wait": arrived - start, "wait": end - arrived}
+
+
+def take_gate(redis_conn, redis_base):
+    """
+    Takes the ticket of the worker from the gate of the barrier without blocking. Returns whether the gate was
+    open.
+    """
+    return redis_conn.lpop(barrier_keys(redis_base)['gate']) is not None
+
+
+def wait_gates(redis_conn, redis_bases, time_min):
+    """
+    Blocks until the gate of any of the barriers is opened and takes its ticket. Returns the barrier opened.
+    """
+    gates = {barrier_keys(b)['gate']: b for b in redis_bases}
+    deadline = time.time() + 60 * time_min
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("The devices were not published in time")
+        opened = redis_conn.blpop(list(gates), timeout=max(1, int(min(remaining, BARRIER_BLOCK))))
+        if opened:
+            key = opened[0].decode() if isinstance(opened[0], bytes) else opened[0]
+            return gates[key]
+
+
+def wait_released(redis_conn, redis_base, time_min, on_idle=None):
+    """
+    Blocks until all the workers have arrived at the barrier without arriving to it. `on_idle` is called every
+    time the wait times out. Returns the seconds waited.
+    """
+    keys = barrier_keys(redis_base)
+    start = time.time()
+    try:
+        left = int(redis_conn.get(keys['semaphore']))
+    except (TypeError, ValueError):
+        left = 0
+    if left > 0:
+        _block_until_(redis_conn, keys['release'], start + 60 * time_min, on_idle)
+    return time.time() - start
@@ -0,0 +1,99 @@
+import functools
+
+import pandas as pd
+
+# bucket grids kept by the process, the devices of a run share the grid of their window
+EDGES_CACHE_SIZE = 256
+
+
+def comparable_freq(freq):
+    """
+    Nominal length of the buckets of the frequency, to compare and sort frequencies (a month is 30 days)
+    """
+    if freq == "P1M":
+        return pd.Timedelta(days=30)
+    else:
+        return pd.Timedelta(freq)
+
+
+def transform_freq(freq):
+    """
+    Frequency of pandas (resample, date_range) with the same buckets as the iso frequency
+    """
+    if freq == "P1M":
+        return "1MS"
+    else:
+        return pd.Timedelta(freq)
+
+
+def isodate_floor(timestamp, freq):
+    """
+    Start of the bucket of `freq` of the timestamp. Weeks start on monday and months are calendar months.
+    """
+    if freq == "P1M":
+        return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif freq == "P1W":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0) - pd.DateOffset(days=timestamp.weekday())
+    else:
+        return timestamp.floor(pd.Timedelta(freq))
+
+
+def bucket_starts(index, freq):
+    """
+    Start of the bucket of `freq` of each timestamp of the DatetimeIndex
+    """
+    if freq == "P1M":
+        return index.to_period("M").to_timestamp()
+    elif freq == "P1W":
+        return index.normalize() - pd.to_timedelta(index.weekday, unit="D")
+    return index.floor(pd.Timedelta(freq))
+
+
+def bucket_ends(starts, freq):
+    """
+    End of each bucket of `freq` starting at `starts`, the start of the next one
+    """
+    if freq == "P1M":
+        return starts + pd.offsets.MonthBegin(1)
+    elif freq == "P1W":
+        return starts + pd.Timedelta(days=7)
+    return starts + pd.Timedelta(freq)
+
+
+@functools.lru_cache(maxsize=EDGES_CACHE_SIZE)
+def _edges_(start, last, freq):
+    starts = pd.date_range(start=start, end=last, freq=transform_freq(freq))
+    return starts.append(bucket_ends(starts[-1:], freq))
+
+
+def bucket_edges(ts_ini, ts_end, freq):
+    """
+    Returns the starts of the buckets of `freq` from the one of `ts_ini` to the one of `ts_end`, followed by the end
+    of the last one. The edges are computed once for each window and frequency and shared, they must not be modified.
+    """
+    return _edges_(isodate_floor(pd.Timestamp(ts_ini), freq), isodate_floor(pd.Timestamp(ts_end), freq), freq)
+
+
+def covering_edges(first, last, freq):
+    """
+    Returns the bucket edges of `freq` covering the whole calendar months from the one of `first` to the one of
+    `last`, so the devices with data in the same months share them.
+    """
+    month_ini = isodate_floor(pd.Timestamp(first), "P1M")
+    month_end = isodate_floor(pd.Timestamp(last), "P1M") + pd.offsets.MonthBegin(1)
+    # the last bucket is the one of the last instant of the month, not the one starting the next month
+    return bucket_edges(month_ini, month_end - pd.Timedelta(1, unit="ns"), freq)
+
+
+def bucket_index(ts_ini, ts_end, freq):
+    """
+    DatetimeIndex with the start of each bucket of `freq` from the one of `ts_ini` to the one of `ts_end`
+    """
+    return bucket_edges(ts_ini, ts_end, freq)[:-1]
+
+
+def bucket_ids(index, edges):
+    """
+    Position in `edges` of the bucket of each timestamp of the index, found with a binary search
+    """
+    return edges.searchsorted(index, side="right") - 1
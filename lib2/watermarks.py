@@ -0,0 +1,44 @@
+import datetime
+
+import pandas as pd
+
+from lib2.time_buckets import isodate_floor
+
+ADVANCE_SCRIPT = """
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > old then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def create_watermarks(redis_conn, redis_key, overlap):
+    """
+    The watermarks are a redis hash with the timestamp of the last point harmonized of each measurement. Raw data
+    is read again from `overlap` seconds before the watermark, to complete the last buckets and get late data.
+    """
+    return {"redis": redis_conn, "key": redis_key, "overlap": overlap}
+
+
+def read_start(watermarks, field, ts_ini, freq):
+    """
+    Returns the timestamp to start reading the raw data of a measurement: the watermark minus the overlap, floored
+    to the frequency, and never before `ts_ini`. Measurements without watermark are read from `ts_ini`.
+    """
+    mark = watermarks['redis'].hget(watermarks['key'], field)
+    if mark is None:
+        return ts_ini
+    # floored to the buckets of the harmonized data, weeks start on monday and months are calendar months
+    start = isodate_floor(pd.Timestamp(int(mark) - watermarks['overlap'], unit="s"), freq).timestamp()
+    if start <= ts_ini.timestamp():
+        return ts_ini
+    return datetime.datetime.fromtimestamp(start, tz=ts_ini.tzinfo)
+
+
+def advance(watermarks, field, ts):
+    """
+    Moves the watermark of the measurement forward to the epoch `ts`, it is never moved backwards.
+    """
+    return watermarks['redis'].eval(ADVANCE_SCRIPT, 1, watermarks['key'], field, int(ts))
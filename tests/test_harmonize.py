@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib2 import harmonize_irregular_data, rollup_harmonized_data
+
+FREQS = ["PT15M", "PT1H"]
+
+
+def reference_harmonize(df, agg_func, freq, value_column):
+    # the harmonization upsampling the series to 1s, replaced by the kernel of harmonize_irregular_data
+    if agg_func == "SUM":
+        remove_neg = df[value_column].diff() < 0
+        df = df[~remove_neg]
+        df_resampled_total = df[value_column].resample('1s').mean().interpolate(method='linear')
+        df_resampled_diff = df_resampled_total.diff()
+        df_resampled_diff = df_resampled_diff[df_resampled_diff >= 0]
+        df_resampled_count = df_resampled_diff.resample(pd.Timedelta(freq)).count()
+        df_resampled_sum = df_resampled_diff.resample(pd.Timedelta(freq)).sum()
+        return pd.DataFrame(df_resampled_sum[df_resampled_count == pd.Timedelta(freq).total_seconds()])
+    elif agg_func == "AVG":
+        df_resampled_total = df[value_column].resample('1s').mean().interpolate(method="linear")
+        df_resampled_count = df_resampled_total.resample(pd.Timedelta(freq)).count()
+        df_resampled_avg = df_resampled_total.resample(pd.Timedelta(freq)).mean()
+        return pd.DataFrame(df_resampled_avg[df_resampled_count == pd.Timedelta(freq).total_seconds()])
+    elif agg_func == "LAST":
+        return pd.DataFrame(df[value_column].resample(pd.Timedelta(freq)).last().ffill())
+
+
+def series(ts, values):
+    return pd.DataFrame({"value": np.asarray(values, dtype=float)},
+                        index=pd.Index(pd.to_datetime(ts, unit="s"), name="timestamp"))
+
+
+def random_series(seed, counter=True):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(2, 120))
+    ts = 1700000000 + int(rng.integers(0, 86400)) + np.cumsum(rng.integers(1, 1500, n))
+    values = np.cumsum(rng.uniform(0, 10, n)) if counter else rng.uniform(-5, 30, n)
+    if counter:
+        # counter drops and flat stretches
+        values[rng.integers(0, n, 2)] -= rng.uniform(0, 40, 2)
+        values[rng.integers(0, n, 3)] = values[0]
+    return series(ts, values)
+
+
+def assert_same(expected, result):
+    assert result.index.equals(expected.index)
+    assert result.index.name == expected.index.name
+    np.testing.assert_allclose(result['value'].values, expected['value'].values, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("freq", FREQS)
+@pytest.mark.parametrize("agg_func,counter", [("SUM", True), ("AVG", False), ("LAST", False)])
+def test_same_as_upsampling_to_seconds(agg_func, counter, freq):
+    for seed in range(40):
+        df = random_series(seed, counter)
+        assert_same(reference_harmonize(df, agg_func, freq, "value"),
+                    harmonize_irregular_data(df, agg_func, freq, "value"))
+
+
+@pytest.mark.parametrize("freq", FREQS)
+def test_counter_drop(freq):
+    step = int(pd.Timedelta(freq).total_seconds()) // 3
+    ts = 1700006400 - 1 + np.arange(12) * step
+    df = series(ts, [0, 1, 2, 3, 4, 5, 1, 7, 8, 9, 10, 11])
+    result = harmonize_irregular_data(df, "SUM", freq, "value")
+    assert_same(reference_harmonize(df, "SUM", freq, "value"), result)
+    assert not result.empty and (result['value'] >= 0).all()
+
+
+@pytest.mark.parametrize("agg_func", ["SUM", "AVG"])
+def test_first_bucket_without_the_second_before(agg_func):
+    # the first sample is at the start of a bucket: SUM needs the second before it, AVG does not
+    start = 1700006400
+    df = series(start + np.arange(0, 3 * 900 + 1, 60), np.arange(46))
+    result = harmonize_irregular_data(df, agg_func, "PT15M", "value")
+    assert_same(reference_harmonize(df, agg_func, "PT15M", "value"), result)
+    assert (pd.Timestamp(start, unit="s") in result.index) == (agg_func == "AVG")
+
+
+@pytest.mark.parametrize("agg_func", ["SUM", "AVG"])
+def test_last_sample_closes_the_bucket(agg_func):
+    # the last sample is the last second of a bucket, which is complete
+    start = 1700006400
+    df = series(np.append(start - 1 + np.arange(0, 1800, 120), start + 1799), np.arange(16))
+    result = harmonize_irregular_data(df, agg_func, "PT15M", "value")
+    assert_same(reference_harmonize(df, agg_func, "PT15M", "value"), result)
+    assert pd.Timestamp(start + 900, unit="s") in result.index
+
+
+def long_series(seed, counter=True):
+    # two months across a february, with a few gaps of days that leave incomplete buckets
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(1, 3600, 3000)
+    steps[rng.integers(0, len(steps), 4)] = rng.integers(86400, 4 * 86400, 4)
+    ts = int(pd.Timestamp("2024-01-20").timestamp()) + int(rng.integers(0, 86400)) + np.cumsum(steps)
+    values = np.cumsum(rng.uniform(0, 10, len(ts))) if counter else rng.uniform(-5, 30, len(ts))
+    return series(ts, values)
+
+
+@pytest.mark.parametrize("from_freq,freq", [("PT15M", "PT1H"), ("PT1H", "P1D"), ("P1D", "P1W"), ("P1D", "P1M"),
+                                            ("PT15M", "P1D")])
+@pytest.mark.parametrize("agg_func,counter", [("SUM", True), ("AVG", False), ("LAST", False)])
+def test_rollup_same_as_harmonizing_at_freq(agg_func, counter, from_freq, freq):
+    for seed in range(5):
+        df = long_series(seed, counter)
+        base = harmonize_irregular_data(df, agg_func, from_freq, "value")
+        result = rollup_harmonized_data(base, agg_func, from_freq, freq, "value")
+        expected = harmonize_irregular_data(df, agg_func, freq, "value")
+        assert not expected.empty
+        assert result.index.equals(expected.index)
+        np.testing.assert_allclose(result['value'].values, expected['value'].values, rtol=1e-9, atol=1e-6)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from harmonizers import harmonize_parts
+from lib2 import harmonize_irregular_data
+from lib2.clean_outliers import no_clean
+
+GAP_CHECKS = [("PT15M", 3600), ("PT1H", 7200)]
+
+
+def reference_parts(dev, source_config, raw_data, freq, gap_check):
+    # the previous harmonization of the irregular data, splitting it at the gaps and harmonizing each part apart
+    start_index = raw_data.index.min() - pd.DateOffset(seconds=1)
+    parts = []
+    check = raw_data.index.diff(1).fillna(pd.Timedelta(0)).total_seconds()
+    for end_idx in raw_data.loc[check > gap_check].index:
+        parts.append(raw_data.loc[start_index:end_idx - pd.DateOffset(seconds=1)])
+        start_index = end_idx
+    parts.append(raw_data.loc[start_index:])
+    df_device_final = pd.DataFrame()
+    for df_h in parts:
+        df_h = source_config['pre_clean'](df_h, dev).dropna(subset=['value'])
+        if df_h.empty:
+            continue
+        df_tmp = harmonize_irregular_data(df_h, dev['harmonized.aggregationFunction'], freq, "value")
+        df_device_final = pd.concat([df_device_final, df_tmp])
+    return df_device_final
+
+
+def raw_with_gap(seed, gap, counter):
+    # six hours of irregular samples on each side of a gap of `gap` seconds
+    rng = np.random.default_rng(seed)
+    before = np.cumsum(rng.integers(30, 300, 120))
+    after = before[-1] + gap + np.cumsum(rng.integers(30, 300, 120))
+    ts = 1700000000 + int(rng.integers(0, 3600)) + np.concatenate([before, after])
+    values = np.cumsum(rng.uniform(0, 10, len(ts))) if counter else rng.uniform(-5, 30, len(ts))
+    raw = pd.DataFrame({"value": values, "freq": "", "ts": ts},
+                       index=pd.Index(pd.to_datetime(ts, unit="s"), name="timestamp"))
+    return raw, pd.Timestamp(ts[119], unit="s"), pd.Timestamp(ts[120], unit="s")
+
+
+@pytest.mark.parametrize("freq,gap_check", GAP_CHECKS)
+@pytest.mark.parametrize("agg_func,counter", [("SUM", True), ("AVG", False), ("LAST", False)])
+def test_parts_are_not_joined_across_gaps(agg_func, counter, freq, gap_check):
+    dev = {'harmonized.aggregationFunction': agg_func}
+    source_config = {'pre_clean': no_clean}
+    length = pd.Timedelta(freq)
+    for seed in range(10):
+        raw, gap_start, gap_end = raw_with_gap(seed, gap_check + 1 + seed * 997, counter)
+        result = harmonize_parts(dev, source_config, raw, freq, gap_check)
+        expected = reference_parts(dev, source_config, raw, freq, gap_check)
+        assert result.index.equals(expected.index)
+        np.testing.assert_allclose(result['value'].values, expected['value'].values, rtol=1e-9, atol=1e-9)
+        starts = result.index
+        if agg_func == "LAST":
+            # the buckets inside the gap are not filled forward with the values before it
+            assert not ((starts > gap_start) & (starts + length <= gap_end)).any()
+        else:
+            # every bucket is covered by the samples of one side of the gap
+            assert ((starts + length <= gap_start + pd.Timedelta(seconds=1)) | (starts >= gap_end)).all()
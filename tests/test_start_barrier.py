@@ -0,0 +1,46 @@
+import multiprocessing
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+redis = pytest.importorskip("redis")
+
+from harmonizers import create_redis_name, process_participant, run_freq_name, wait_sync_redis
+from lib2.redis_sync import open_barrier
+
+FREQ = {"freq": "PT1H"}
+
+
+def _processor_(port, results):
+    # a processor process of the host joining the start barrier as processor_job does
+    redis_conn = redis.Redis(host="127.0.0.1", port=port)
+    try:
+        wait_sync_redis(redis_conn, "harmonizer.start", FREQ, None, 2, 0.5, participant=process_participant())
+        results.put("started")
+    except TimeoutError:
+        results.put("timeout")
+
+
+@pytest.fixture
+def redis_port():
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_processors_of_the_same_host_arrive_apart(redis_port):
+    redis_conn = redis.Redis(host="127.0.0.1", port=redis_port)
+    open_barrier(redis_conn, create_redis_name("harmonizer.start", run_freq_name(FREQ), None), 2)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processors = [context.Process(target=_processor_, args=(redis_port, results)) for _ in range(2)]
+    for p in processors:
+        p.start()
+    for p in processors:
+        p.join(60)
+    assert sorted(results.get(timeout=5) for _ in processors) == ["started", "started"]
+
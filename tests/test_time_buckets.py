@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from lib2.time_buckets import bucket_ends, bucket_starts, covering_edges
+
+
+def index(*timestamps):
+    return pd.DatetimeIndex([pd.Timestamp(t) for t in timestamps])
+
+
+def test_weeks_start_on_monday():
+    starts = bucket_starts(index("2024-01-31 13:00", "2024-02-04 23:59:59", "2024-02-05 00:00", "1970-01-01"), "P1W")
+    assert list(starts) == list(index("2024-01-29", "2024-01-29", "2024-02-05", "1969-12-29"))
+    assert (starts.weekday == 0).all()
+    assert list(bucket_ends(starts, "P1W")) == list(index("2024-02-05", "2024-02-05", "2024-02-12", "1970-01-05"))
+
+
+@pytest.mark.parametrize("timestamp,start,end", [
+    ("2024-01-31 23:59:59", "2024-01-01", "2024-02-01"),
+    ("2024-01-01 00:00", "2024-01-01", "2024-02-01"),
+    ("2024-02-29 12:00", "2024-02-01", "2024-03-01"),
+    ("2023-02-28 23:59:59", "2023-02-01", "2023-03-01"),
+    ("2023-12-31 23:00", "2023-12-01", "2024-01-01"),
+])
+def test_calendar_months(timestamp, start, end):
+    starts = bucket_starts(index(timestamp), "P1M")
+    assert starts[0] == pd.Timestamp(start)
+    assert bucket_ends(starts, "P1M")[0] == pd.Timestamp(end)
+
+
+def test_covering_edges_of_months():
+    assert list(covering_edges("2024-01-15", "2024-02-10", "P1M")) == list(index("2024-01-01", "2024-02-01",
+                                                                                  "2024-03-01"))
+    hours = covering_edges("2024-01-31 10:00", "2024-01-31 11:00", "PT1H")
+    assert hours[0] == pd.Timestamp("2024-01-01") and hours[-1] == pd.Timestamp("2024-02-01")
+    assert len(hours) == 31 * 24 + 1
+    days = covering_edges("2023-02-10", "2023-02-20", "P1D")
+    assert days[0] == pd.Timestamp("2023-02-01") and days[-1] == pd.Timestamp("2023-03-01")
+    assert len(days) == 28 + 1
+
+
+def test_covering_edges_of_weeks():
+    weeks = covering_edges("2023-02-10", "2023-02-20", "P1W")
+    assert weeks[0] == pd.Timestamp("2023-01-30") and weeks[-1] == pd.Timestamp("2023-03-06")
+    assert (weeks.weekday == 0).all()
+    assert (weeks[1:] - weeks[:-1] == pd.Timedelta(days=7)).all()
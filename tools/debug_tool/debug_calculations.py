@@ -1,12 +1,13 @@
 import datetime
 import beelib
 import load_dotenv
-import neo4j
 import xml.etree.ElementTree as ElementTree
 import pandas as pd
+from harmonizers import CALCULATION_QUERY
 from launcher_v2 import FREQ_CONFIG
 from lib2 import send_to_kafka
-from lib2.calculate_formulas import CalculateFunctions
+from lib2.calculate_formulas import CalculateFunctions, formula_uris
+from lib2.connections import run_query
 from tools.plot_utils import plot_dataframes
 
 
@@ -21,19 +22,12 @@ ts_end = datetime.datetime.fromisoformat("2025-05-01T19:00:00+00:00")
 
 load_dotenv.load_dotenv()
 config = beelib.beeconfig.read_config('config_prod.json')
-driver = neo4j.GraphDatabase.driver(**config['neo4j'])
 
 
-calc_query = f"""
-                MATCH (m)-[:s4city__quantifiesKPI|:saref__relatesToProperty]->(prop) 
-                WHERE m.bee__calculationFormula IS NOT NULL AND m.bigg__measurementFrequency="{freq['freq']}"
-                RETURN {{bigg__hash: m.bigg__hash, 
-                bee__calculationFormula: m.bee__calculationFormula, 
-                bigg__measurementFrequency: m.bigg__measurementFrequency,
-                property:prop.uri}} AS m
-            """
-devices = [d['m'] for d in driver.session().run(calc_query).data()]
+devices = [d['m'] for d in run_query(config['neo4j'], CALCULATION_QUERY, freq=freq['freq'])]
 devices = [d for d in devices if d['bigg__hash'] in calculation_hashes]
+calculator = CalculateFunctions({}, {}, config['influx'], config['neo4j'], "influx")
+calculator.resolve_measurements([u for d in devices for u in formula_uris(d["bee__calculationFormula"])])
 
 all_results = {}
 all_components = {}
@@ -41,8 +35,6 @@ for dev in devices:
     formula = dev["bee__calculationFormula"]
     formula = f"<root>{formula}</root>"
     formula_tree = ElementTree.fromstring(formula)
-    calculator = CalculateFunctions({}, {}, config['influx'], config['neo4j'],
-                                    "influx")
     try:
         components = calculator.get_timeseries_components(formula_tree, ts_ini, ts_end, freq['freq'])
         result = calculator.calculate_formula(formula_tree, ts_ini, ts_end, freq['freq'])
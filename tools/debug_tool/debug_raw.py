@@ -3,16 +3,17 @@ import time
 from urllib.parse import quote
 import beelib
 import load_dotenv
-import neo4j
 import numpy as np
 import pandas as pd
 import pytz
-from harmonizers import harmonize_raw_data, get_raw_data
+from harmonizers import query_source_devices, harmonize_raw_data, get_raw_data
 from harmonizers.sources.bacnet import bacnet
 from harmonizers.sources.dexma import dexma
 from harmonizers.sources.manttest import manttest, manttest_eco
 from harmonizers.sources.modbus import modbus
 from launcher_v2 import FREQ_CONFIG
+from lib2.query_cache import create_query_cache
+from lib2.raw_cache import configure_raw_cache
 from tools.plot_utils import plot_dataframes
 
 
@@ -35,36 +36,18 @@ ts_ini = ts_end - datetime.timedelta(days=7)
 
 load_dotenv.load_dotenv()
 config = beelib.beeconfig.read_config(config_file)
-driver = neo4j.GraphDatabase.driver(**config['neo4j'])
+# device queries are reused between debugging runs, remove the folder to read them again
+query_cache = create_query_cache(path=".query_cache")
+# raw data of the closed days is also kept between runs, remove the folder to read it again from hbase
+configure_raw_cache(".raw_cache")
 
 # GET RAW DEVICES BY SOURCE
 raw_dev = {}
 for i, s in enumerate(sources):
-    source_devices = pd.DataFrame()
-    for s_t in s['device_query']:
-        try:
-            for attempt in range(5):
-                try:
-                    devices = driver.session().run(s_t.format(freq=freq['freq'])).data()
-                    break
-                except Exception as e:
-                    devices = []
-                    pass
-            if not devices:
-                print("no devices")
-                continue
-            device_df = pd.json_normalize(devices).explode("raw_data")
-            device_df = pd.concat([device_df.drop('raw_data', axis=1),
-                                   device_df['raw_data'].apply(pd.Series).rename(
-                                       columns={c: f"raw_data.{c}" for c in
-                                                device_df['raw_data'].apply(pd.Series).columns})], axis=1)
-            source_devices = pd.concat([source_devices, device_df])
-        except KeyError as e:
-            print(e)
-            pass
-    if source_devices.empty:
+    source_devices = query_source_devices(config['neo4j'], s, freq, query_cache)
+    if not source_devices:
         continue
-    raw_dev[i] = source_devices[source_devices['harmonized.bigg__hash'].isin(harmonized_hashes)]
+    raw_dev[i] = [d for d in source_devices if d['harmonized.bigg__hash'] in harmonized_hashes]
 
 
 
@@ -72,10 +55,10 @@ for i, s in enumerate(sources):
 raw_data = []
 harm_data = []
 harm_data_total = {}
-for i, df_dev in raw_dev.items():
+for i, devs in raw_dev.items():
     source = sources[i]
     has_count = {}
-    for _, dev in df_dev.iterrows():
+    for dev in devs:
         try:
             has_count[dev['harmonized.bigg__hash']] = has_count[dev['harmonized.bigg__hash']] + 1
         except KeyError as e:
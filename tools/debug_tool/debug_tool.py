@@ -5,17 +5,19 @@ from urllib.parse import quote
 
 import beelib
 import load_dotenv
-import neo4j
 import pandas as pd
 import pytz
 import xml.etree.ElementTree as ElementTree
 
 
-from harmonizers import harmonize_raw_data, PVProcessor, get_raw_data
+from harmonizers import CALCULATION_QUERY, query_source_devices, harmonize_raw_data, PVProcessor, get_raw_data
 from harmonizers.sources.dexma import dexma
 from harmonizers.sources.modbus import modbus
 from launcher_v2 import FREQ_CONFIG
-from lib2.calculate_formulas import CalculateFunctions
+from lib2.query_cache import create_query_cache
+from lib2.raw_cache import configure_raw_cache
+from lib2.calculate_formulas import CalculateFunctions, formula_uris
+from lib2.connections import run_query
 from tools.plot_utils import plot_dataframes
 
 ts_ini = datetime.datetime.fromisoformat("2025-02-28T00:00:00+00:00")
@@ -31,40 +33,27 @@ freq = FREQ_CONFIG["PT15M"]
 
 load_dotenv.load_dotenv()
 config = beelib.beeconfig.read_config(config_file)
-driver = neo4j.GraphDatabase.driver(**config['neo4j'])
+# device queries are reused between debugging runs, remove the folder to read them again
+query_cache = create_query_cache(path=".query_cache")
+# raw data of the closed days is also kept between runs, remove the folder to read it again from hbase
+configure_raw_cache(".raw_cache")
 
 # GET RAW DEVICES BY SOURCE
 raw_dev = {}
 for i, s in enumerate(sources):
-    source_devices = pd.DataFrame()
-    for s_t in s['device_query']:
-        try:
-            for attempt in range(5):
-                try:
-                    devices = driver.session().run(s_t.format(freq=freq['freq'])).data()
-                    break
-                except Exception as e:
-                    pass
-            device_df = pd.json_normalize(devices).explode("raw_data")
-            device_df = pd.concat([device_df.drop('raw_data', axis=1),
-                                   device_df['raw_data'].apply(pd.Series).rename(
-                                       columns={c: f"raw_data.{c}" for c in
-                                                device_df['raw_data'].apply(pd.Series).columns})], axis=1)
-            source_devices = pd.concat([source_devices, device_df])
-        except KeyError:
-            pass
-    if source_devices.empty:
+    source_devices = query_source_devices(config['neo4j'], s, freq, query_cache)
+    if not source_devices:
         continue
-    raw_dev[i] = source_devices[source_devices['raw_data.uri'].apply(lambda x: True if quote(patrimony_id) in x else False)]
-    raw_dev[i] = raw_dev[i][raw_dev[i]['harmonized.bigg__hash'].isin(harmonized_hashes)]
+    raw_dev[i] = [d for d in source_devices if quote(patrimony_id) in d['raw_data.uri'] and
+                  d['harmonized.bigg__hash'] in harmonized_hashes]
 
 # HARMONIZE RAW DATA BY SOURCE
 raw_data = []
 harm_data = []
 harm_data_total = {}
-for i, df_dev in raw_dev.items():
+for i, devs in raw_dev.items():
     source = sources[i]
-    for _, dev in df_dev.iterrows():
+    for dev in devs:
         r_data = get_raw_data(dev, source, config['hbase'], ts_ini, ts_end, freq)
         raw_data.append({"source": i, dev['harmonized.bigg__hash']: r_data})
         s = time.time()
@@ -147,8 +136,7 @@ for hash_, data in harm_data_total.items():
 # GET POST PROCESSORS DEVICES
 post_dev = {}
 for i, post in enumerate(post_processors):
-    query = post.get_devices(freq)
-    devices = driver.session().run(query).data()
+    devices = run_query(config['neo4j'], post.get_devices(), freq=freq['freq'])
     if not devices:
         continue
     devices = pd.DataFrame(devices)
@@ -212,24 +200,16 @@ for hash_ in post_harm.keys():
 
 # CALCULATION DEVICES
 
-calc_query = f"""
-                MATCH (m)-[:s4city__quantifiesKPI|:saref__relatesToProperty]->(prop) 
-                WHERE m.bee__calculationFormula IS NOT NULL AND m.bigg__measurementFrequency="{freq['freq']}"
-                RETURN {{bigg__hash: m.bigg__hash, 
-                bee__calculationFormula: m.bee__calculationFormula, 
-                bigg__measurementFrequency: m.bigg__measurementFrequency,
-                property:prop.uri}} AS m
-            """
-devices = [d['m'] for d in driver.session().run(calc_query).data()]
+devices = [d['m'] for d in run_query(config['neo4j'], CALCULATION_QUERY, freq=freq['freq'])]
 devices = [d for d in devices if d['bigg__hash'] in calculation_hashes]
+calculator = CalculateFunctions({}, {}, config['influx'], config['neo4j'], "influx")
+calculator.resolve_measurements([u for d in devices for u in formula_uris(d["bee__calculationFormula"])])
 
 all_results = {}
 for dev in devices:
     formula = dev["bee__calculationFormula"]
     formula = f"<root>{formula}</root>"
     formula_tree = ElementTree.fromstring(formula)
-    calculator = CalculateFunctions({}, {}, config['influx'], config['neo4j'],
-                                    "influx")
     try:
         components = calculator.get_timeseries_components(formula_tree, ts_ini, ts_end, freq['freq'])
         result = calculator.calculate_formula(formula_tree, ts_ini, ts_end, freq['freq'])